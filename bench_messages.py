@@ -0,0 +1,39 @@
+import json
+import timeit
+
+import messages
+
+CHAT_FRAME = json.dumps({'type': 'chat', 'username': 'someone', 'message': '你好，Simple Chat！' * 4})
+INIT_FRAME = json.dumps({'type': 'init', 'username': 'someone'})
+
+
+def assert_based_chat(frame):
+    data = json.loads(frame)
+    assert data['type'] == 'chat'
+    return data['message'].strip()
+
+
+def assert_based_init(frame):
+    data = json.loads(frame)
+    assert data['type'] == 'init'
+    return data['username']
+
+
+def schema_chat(frame):
+    return messages.decode(frame).message.strip()
+
+
+def schema_init(frame):
+    return messages.decode(frame).username
+
+
+if __name__ == '__main__':
+    number = 200000
+    for name, function, frame in [
+        ('assert-based chat', assert_based_chat, CHAT_FRAME),
+        ('schema chat', schema_chat, CHAT_FRAME),
+        ('assert-based init', assert_based_init, INIT_FRAME),
+        ('schema init', schema_init, INIT_FRAME),
+    ]:
+        seconds = min(timeit.repeat(lambda: function(frame), number=number, repeat=5))
+        print(name.ljust(20) + str(round(seconds / number * 1e9)) + ' ns/frame')
@@ -0,0 +1,190 @@
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import struct
+import time
+
+import websockets
+from websockets.exceptions import ConnectionClosed
+
+MAGIC = b'SCCAP1\n'
+# Offset in seconds since the start of the capture, event kind, anonymized user id, message length
+RECORD = struct.Struct('<dBIH')
+
+INIT = 0
+CHAT = 1
+DISCONNECT = 2
+
+# Buffered records are written out at least this often, so a killed server loses at most this much of the capture
+FLUSH_INTERVAL = 1.0
+# How long a replayed user waits for the echoes of its messages before disconnecting
+ECHO_TIMEOUT = 5.0
+
+Event = collections.namedtuple('Event', ['offset', 'kind', 'user_id', 'length'])
+
+
+class Recorder:
+    """
+    Writes anonymized, timestamped inbound events to a compact binary capture file.
+
+    Usernames and message contents are not recorded: users are numbered in order of connection and messages are
+    reduced to their length. Writes go through a large buffer so recording does not block the event loop.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'wb', buffering=1 << 16)
+        self.file.write(MAGIC)
+        self.t0 = time.monotonic()
+        self.last_flush = self.t0
+        self.user_ids = itertools.count()
+
+    def new_user_id(self) -> int:
+        return next(self.user_ids)
+
+    def record(self, kind, user_id, length=0) -> None:
+        now = time.monotonic()
+        self.file.write(RECORD.pack(now - self.t0, kind, user_id, min(length, 0xffff)))
+        if now - self.last_flush >= FLUSH_INTERVAL:
+            self.file.flush()
+            self.last_flush = now
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def read_capture(path) -> list:
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a capture file: ' + path)
+        data = f.read()
+    return [Event(*fields) for fields in RECORD.iter_unpack(data[:len(data) - len(data) % RECORD.size])]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class ReplayedUser:
+    def __init__(self, url, user_id, stats):
+        self.url = url
+        self.username = 'replay' + str(user_id)
+        self.stats = stats
+
+        self.events = asyncio.Queue()
+        self.connection = None
+        self.receiver = None
+        self.sent_times = dict()
+        self.tokens = itertools.count()
+
+    async def run(self) -> None:
+        try:
+            while True:
+                event = await self.events.get()
+                if event.kind == INIT:
+                    self.connection = await websockets.connect(self.url, ping_interval=None)
+                    await self.connection.send(json.dumps({'type': 'init', 'username': self.username}))
+                    data = json.loads(await self.connection.recv())
+                    if data['type'] != 'online_success':
+                        self.stats['failed_logins'] += 1
+                        await self.connection.close()
+                        return
+                    self.receiver = asyncio.ensure_future(self.receive())
+                elif event.kind == CHAT and self.connection is not None:
+                    token = str(next(self.tokens))
+                    self.sent_times[token] = time.perf_counter()
+                    await self.connection.send(json.dumps({
+                        'type': 'chat',
+                        'message': token + ' ' + 'x' * max(0, event.length - len(token) - 1)
+                    }))
+                    self.stats['sent'] += 1
+                elif event.kind == DISCONNECT:
+                    if self.receiver is not None:
+                        await self.wait_for_echoes()
+                    return
+        except (OSError, ConnectionClosed):
+            self.stats['errors'] += 1
+        finally:
+            if self.connection is not None:
+                await self.connection.close()
+            if self.receiver is not None:
+                self.receiver.cancel()
+
+    async def wait_for_echoes(self) -> None:
+        deadline = time.perf_counter() + ECHO_TIMEOUT
+        while self.sent_times and not self.receiver.done() and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        self.stats['lost'] += len(self.sent_times)
+
+    async def receive(self) -> None:
+        try:
+            async for message in self.connection:
+                data = json.loads(message)
+                if data['type'] == 'chat' and data['username'] == self.username:
+                    t = self.sent_times.pop(data['message'].split(' ', 1)[0], None)
+                    if t is not None:
+                        self.stats['latencies'].append(time.perf_counter() - t)
+        except ConnectionClosed:
+            pass
+
+
+async def replay(path, url, speed=1.0) -> dict:
+    """Drive the server at `url` with the events of a capture file. A `speed` of 0 replays as fast as possible."""
+    events = read_capture(path)
+    stats = {'sent': 0, 'lost': 0, 'errors': 0, 'failed_logins': 0, 'latencies': [], 'lags': []}
+
+    # The schedule starts at the first event, not at the start of the capture, which may precede it by hours
+    first_offset = events[0].offset if events else 0.0
+    users = dict()
+    tasks = []
+    t0 = time.perf_counter()
+    for event in events:
+        if speed:
+            # Sleep until the event is due, and remember how late it actually goes out
+            delay = (event.offset - first_offset) / speed - (time.perf_counter() - t0)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            stats['lags'].append(max(0.0, -delay))
+        if event.kind == INIT:
+            users[event.user_id] = ReplayedUser(url, event.user_id, stats)
+            tasks.append(asyncio.ensure_future(users[event.user_id].run()))
+        user = users.get(event.user_id)
+        if user is not None:
+            user.events.put_nowait(event)
+    for user in users.values():
+        user.events.put_nowait(Event(0.0, DISCONNECT, 0, 0))
+    await asyncio.gather(*tasks)
+    duration = time.perf_counter() - t0
+
+    recorded_duration = events[-1].offset - events[0].offset if events else 0.0
+    recorded_chats = sum(1 for event in events if event.kind == CHAT)
+    return {
+        'recorded_seconds': recorded_duration,
+        'recorded_chats_per_second': recorded_chats / recorded_duration if recorded_duration else 0.0,
+        'replay_seconds': duration,
+        'replay_chats_per_second': stats['sent'] / duration if duration else 0.0,
+        'time_scale': duration / recorded_duration if recorded_duration else 0.0,
+        'schedule_lag_p99': percentile(stats['lags'], 0.99),
+        'latency_p50': percentile(stats['latencies'], 0.5),
+        'latency_p99': percentile(stats['latencies'], 0.99),
+        'latency_max': max(stats['latencies'], default=0.0),
+        'lost_echoes': stats['lost'],
+        'errors': stats['errors'],
+        'failed_logins': stats['failed_logins'],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a traffic capture against a local server.')
+    parser.add_argument('capture')
+    parser.add_argument('--server', default='ws://127.0.0.1:34999/')
+    parser.add_argument('--speed', default='1', help='time scale such as 1 or 10, or "max"')
+    args = parser.parse_args()
+
+    result = asyncio.run(replay(args.capture, args.server, 0.0 if args.speed == 'max' else float(args.speed)))
+    for key, value in result.items():
+        print(key + ': ' + str(round(value, 4) if type(value) is float else value))
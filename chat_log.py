@@ -0,0 +1,246 @@
+import asyncio
+import bisect
+import glob
+import json
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+from loguru import logger
+
+# Live segments are rotated once they reach this size
+SEGMENT_SIZE = 4 << 20
+# Uncompressed size of an archive block, the unit of decompression on reads
+BLOCK_SIZE = 64 << 10
+COMPACTION_INTERVAL = 60.0
+# Compaction sleeps between blocks so that it reads and writes at most this many bytes per second
+COMPACTION_BYTES_PER_SECOND = 8 << 20
+FLUSH_INTERVAL = 1.0
+
+ARCHIVE_MAGIC = b'SCARC1\n'
+INDEX_LENGTH = struct.Struct('<Q')
+
+
+class ChatLog:
+    """
+    Persistent log of chat messages in a directory.
+
+    New messages are appended as JSON lines to segment files. Closed segments are compacted in the background into
+    archives of zlib-compressed blocks. Each archive ends with a sparse index holding the first sequence number and
+    timestamp, offset, length and CRC-32 of every block, so that reads only decompress the blocks they need.
+
+    `append`, `flush` and `closed_segments` are called on the event loop, `compact` and `read_since` in a worker
+    thread.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+        # The sequence space outlives the process, so the history id is stored with the log. After a crash the last
+        # messages may be lost and their sequence numbers reused, so the id is only kept if the log was closed cleanly.
+        history_id_path = os.path.join(directory, 'history_id')
+        self.closed_path = os.path.join(directory, 'closed')
+        if os.path.exists(history_id_path) and os.path.exists(self.closed_path):
+            with open(history_id_path) as f:
+                self.history_id = f.read().strip()
+        else:
+            if os.path.exists(history_id_path):
+                logger.warning('Chat log in [' + directory + '] was not closed cleanly, starting a new history id.')
+            self.history_id = uuid.uuid4().hex
+            with open(history_id_path, 'w') as f:
+                f.write(self.history_id)
+                f.flush()
+                os.fsync(f.fileno())
+        if os.path.exists(self.closed_path):
+            os.remove(self.closed_path)
+
+        self.lock = threading.Lock()
+        self.indexes = dict()
+
+        self.file = None
+        self.file_size = 0
+        self.last_seq = self._recover_last_seq()
+
+    def _paths(self, pattern) -> list:
+        return sorted(glob.glob(os.path.join(self.directory, pattern)))
+
+    @staticmethod
+    def _first_seq(path) -> int:
+        return int(os.path.basename(path).split('-')[1].split('.')[0])
+
+    def _recover_last_seq(self) -> int:
+        segments = self._paths('segment-*.jsonl')
+        if segments:
+            messages = self._read_segment(segments[-1])
+            if messages:
+                return messages[-1]['seq']
+            return self._first_seq(segments[-1]) - 1
+        archives = self._paths('archive-*.sca')
+        if archives:
+            with open(archives[-1], 'rb') as f:
+                index = self._load_index(archives[-1], f)
+                return self._read_block(f, index[-1])[-1]['seq']
+        return 0
+
+    def append(self, message: dict) -> None:
+        if self.file is None or self.file_size >= SEGMENT_SIZE:
+            self._rotate(message['seq'])
+        line = (json.dumps(message, ensure_ascii=False) + '\n').encode()
+        self.file.write(line)
+        self.file_size += len(line)
+        self.last_seq = message['seq']
+
+    def flush(self) -> None:
+        if self.file is not None:
+            self.file.flush()
+
+    def _rotate(self, first_seq) -> None:
+        if self.file is not None:
+            self.file.close()
+        path = os.path.join(self.directory, 'segment-%012d.jsonl' % first_seq)
+        self.file = open(path, 'ab', buffering=1 << 16)
+        self.file_size = self.file.tell()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+        # Marks the log as complete, see `__init__`
+        open(self.closed_path, 'w').close()
+
+    def closed_segments(self) -> list:
+        """Return the segments no longer appended to. Called on the event loop, so that it cannot race a rotation."""
+        current = self.file.name if self.file is not None else None
+        return [path for path in self._paths('segment-*.jsonl') if path != current]
+
+    def compact(self, segments, bytes_per_second=COMPACTION_BYTES_PER_SECOND) -> None:
+        """Rewrite the given closed segments into archives."""
+        for path in segments:
+            self._compact_segment(path, bytes_per_second)
+
+    def _compact_segment(self, path, bytes_per_second) -> None:
+        archive_path = os.path.join(self.directory, 'archive-%012d.sca' % self._first_seq(path))
+        temporary_path = archive_path + '.tmp'
+
+        with open(path, 'rb') as segment, open(temporary_path, 'wb') as archive:
+            archive.write(ARCHIVE_MAGIC)
+            index = []
+            block = []
+            block_size = 0
+            for line in segment:
+                if not line.endswith(b'\n'):
+                    break
+                block.append(line)
+                block_size += len(line)
+                if block_size >= BLOCK_SIZE:
+                    index.append(self._write_block(archive, block))
+                    time.sleep(block_size / bytes_per_second)
+                    block, block_size = [], 0
+            if block:
+                index.append(self._write_block(archive, block))
+
+            index_bytes = json.dumps(index).encode()
+            archive.write(index_bytes)
+            archive.write(INDEX_LENGTH.pack(len(index_bytes)))
+            archive.flush()
+            os.fsync(archive.fileno())
+
+        with self.lock:
+            if index:
+                os.replace(temporary_path, archive_path)
+            else:
+                os.remove(temporary_path)
+            os.remove(path)
+        logger.info('Compacted [' + os.path.basename(path) + '] into [' + os.path.basename(archive_path) + '].')
+
+    @staticmethod
+    def _write_block(archive, lines) -> list:
+        first = json.loads(lines[0])
+        compressed = zlib.compress(b''.join(lines))
+        offset = archive.tell()
+        archive.write(compressed)
+        return [first['seq'], first['timestamp'], offset, len(compressed), zlib.crc32(compressed)]
+
+    def _load_index(self, path, f) -> list:
+        index = self.indexes.get(path)
+        if index is None:
+            f.seek(-INDEX_LENGTH.size, os.SEEK_END)
+            index_length, = INDEX_LENGTH.unpack(f.read(INDEX_LENGTH.size))
+            f.seek(-INDEX_LENGTH.size - index_length, os.SEEK_END)
+            index = self.indexes[path] = json.loads(f.read(index_length))
+        return index
+
+    @staticmethod
+    def _read_block(f, entry) -> list:
+        _, _, offset, length, crc = entry
+        f.seek(offset)
+        compressed = f.read(length)
+        if zlib.crc32(compressed) != crc:
+            raise ValueError('corrupted block at offset ' + str(offset) + ' of [' + f.name + ']')
+        return [json.loads(line) for line in zlib.decompress(compressed).splitlines()]
+
+    @staticmethod
+    def _read_segment(path) -> list:
+        messages = []
+        with open(path, 'rb') as f:
+            for line in f:
+                # A line being written concurrently may be incomplete
+                if not line.endswith(b'\n'):
+                    break
+                messages.append(json.loads(line))
+        return messages
+
+    def read_since(self, seq=None, timestamp=None, limit=None) -> list:
+        """Return up to `limit` messages after sequence number `seq` and not before `timestamp`, where given."""
+
+        def wanted(message):
+            return (seq is None or message['seq'] > seq) and (timestamp is None or message['timestamp'] >= timestamp)
+
+        result = []
+        with self.lock:
+            archives = self._paths('archive-*.sca')
+            segments = self._paths('segment-*.jsonl')
+            first_seqs = [self._first_seq(path) for path in archives + segments]
+
+            for i, path in enumerate(archives):
+                # Skip archives that end before the requested position
+                if seq is not None and i + 1 < len(first_seqs) and first_seqs[i + 1] - 1 <= seq:
+                    continue
+                with open(path, 'rb') as f:
+                    index = self._load_index(path, f)
+                    start = 0
+                    if seq is not None:
+                        start = max(start, bisect.bisect_right([entry[0] for entry in index], seq) - 1)
+                    if timestamp is not None:
+                        start = max(start, bisect.bisect_left([entry[1] for entry in index], timestamp) - 1)
+                    for entry in index[start:]:
+                        result.extend(message for message in self._read_block(f, entry) if wanted(message))
+                        if limit is not None and len(result) >= limit:
+                            return result[:limit]
+
+            for path in segments:
+                result.extend(message for message in self._read_segment(path) if wanted(message))
+                if limit is not None and len(result) >= limit:
+                    return result[:limit]
+        return result
+
+    async def maintain_forever(self) -> None:
+        """Flush the current segment every FLUSH_INTERVAL seconds and compact every COMPACTION_INTERVAL seconds."""
+        loop = asyncio.get_event_loop()
+        next_compaction = loop.time() + COMPACTION_INTERVAL
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            self.flush()
+            if loop.time() < next_compaction:
+                continue
+            next_compaction = loop.time() + COMPACTION_INTERVAL
+            try:
+                await loop.run_in_executor(None, self.compact, self.closed_segments())
+            except (OSError, ValueError) as e:
+                logger.warning('Chat log compaction failed: ' + str(e))
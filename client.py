@@ -1,10 +1,21 @@
+import argparse
 import asyncio
+import collections
+import sys
 import time
 import typing
 
-import websockets
 import json
+from websockets.exceptions import ConnectionClosed
 
+import server_selection
+
+# Maximum number of bytes read from stdin at once in pipe mode
+PIPE_READ_SIZE = 1 << 16
+# Received frames are written to stdout at least this often in pipe mode
+PIPE_FLUSH_INTERVAL = 0.05
+# Delay between attempts to reach a server after a disconnect
+RECONNECT_INTERVAL = 1.0
 
 async def send(connection, message: typing.Union[str, dict]):
     if type(message) is dict:
@@ -17,13 +28,34 @@ async def recv(connection) -> dict:
     return json.loads(await connection.recv())
 
 
-async def send_handler(connection, username):
+async def line_reader(queue: asyncio.Queue):
+    """Put every line typed on stdin on `queue`, None at EOF. One reader outlives reconnects, so no line is lost."""
     loop = asyncio.get_event_loop()
     while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if not line:
+            queue.put_nowait(None)
+            return
+        queue.put_nowait(line.rstrip('\n'))
+
+
+async def read_line(lines: asyncio.Queue, prompt='') -> str:
+    print(prompt, end='', flush=True)
+    line = await lines.get()
+    if line is None:
+        raise EOFError
+    return line
+
+
+async def send_handler(connection, username, lines: asyncio.Queue):
+    while True:
+        line = await lines.get()
+        if line is None:
+            return
         await send(connection, {
             'type': 'chat',
             'username': username,
-            'message': await loop.run_in_executor(None, input)
+            'message': line
         })
 
 
@@ -33,48 +65,194 @@ async def receive_handler(connection):
         if data['type'] == 'chat':
             print(data['username'] + ' [' +
                   time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(data['timestamp'])) +
-                  ']: ')
-            print(data['message'])
+                  ']: \n' + data['message'])
         elif data['type'] == 'user_online':
             print('用户' + data['username'] + '已上线')
         elif data['type'] == 'user_offline':
             print('用户' + data['username'] + '已下线')
+        elif data['type'] == 'invalid_message':
+            print('消息无效：' + data['reason'])
+
 
+async def stdin_reader(queue: asyncio.Queue):
+    """Read stdin as a stream and put the complete lines of every chunk on `queue` as one batch, None at EOF."""
+    loop = asyncio.get_event_loop()
+    pending = b''
+    while True:
+        chunk = await loop.run_in_executor(None, sys.stdin.buffer.read1, PIPE_READ_SIZE)
+        if not chunk:
+            if pending:
+                queue.put_nowait([pending.decode(errors='replace')])
+            queue.put_nowait(None)
+            return
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        queue.put_nowait([line.decode(errors='replace') for line in lines])
 
-async def main():
-    async with websockets.connect('ws://127.0.0.1:34999/', ping_interval=None) as connection:
-        loop = asyncio.get_event_loop()
 
-        username = await loop.run_in_executor(None, input, '请输入用户名：')
+async def pipe_send_handler(connection, queue: asyncio.Queue, unsent: collections.deque, drained: asyncio.Event):
+    """
+    Send the lines of stdin, then wait until the server has broadcast all of them.
+
+    Lines stay in `unsent` until they are written to the connection, and the None marking EOF stays there for good, so
+    that both survive a failover to another server.
+    """
+    while True:
+        if not unsent:
+            batch = await queue.get()
+            unsent.extend(batch if batch is not None else [None])
+        while unsent:
+            line = unsent[0]
+            if line is None:
+                # The server handles frames in order, so its pong means every message before it has been broadcast
+                await connection.send(json.dumps({'type': 'ping', 'id': 0}))
+                await drained.wait()
+                return
+            if line.strip():
+                await connection.send(json.dumps({'type': 'chat', 'message': line}))
+            unsent.popleft()
+        # Yield once per batch rather than once per message
+        await asyncio.sleep(0)
+
+
+async def pipe_receive_handler(connection, drained: asyncio.Event):
+    # Frames are JSON already, so they are written out as JSON lines without being decoded
+    out = sys.stdout.buffer
+    flushed = time.monotonic()
+    while True:
+        # Unlike `async for`, recv raises on every close, so that a server going away is never taken for the end
+        message = await connection.recv()
+        if type(message) is bytes:
+            message = message.decode()
+        if '"pong"' in message and json.loads(message)['type'] == 'pong':
+            drained.set()
+            continue
+        out.write(message.encode())
+        out.write(b'\n')
+        if time.monotonic() - flushed >= PIPE_FLUSH_INTERVAL:
+            out.flush()
+            flushed = time.monotonic()
+
+
+async def pipe_flush_handler():
+    while True:
+        await asyncio.sleep(PIPE_FLUSH_INTERVAL)
+        sys.stdout.buffer.flush()
+
+
+async def login(connection, username=None, lines: asyncio.Queue = None) -> str:
+    """Log in, prompting for usernames read from `lines`. Without `lines` the login is not interactive."""
+    interactive = lines is not None
+    if username is None:
+        username = await read_line(lines, '请输入用户名：')
+    await send(connection, {
+        'type': 'init',
+        'username': username
+    })
+    data = await recv(connection)
+
+    while True:
+        if not interactive and data['type'] != 'online_success':
+            raise RuntimeError('login as (' + str(username) + ') failed: ' + json.dumps(data))
+        elif data['type'] == 'empty_username':
+            print('用户名不可为空！请重新输入：')
+        elif data['type'] == 'duplicate_username':
+            print('已存在该用户名！请重新输入：')
+        elif data['type'] == 'server_busy':
+            print('服务器繁忙！请稍后重新输入：')
+        elif data['type'] == 'invalid_message':
+            print('用户名无效（' + data['reason'] + '）！请重新输入：')
+        else:
+            break
+
+        username = await read_line(lines, '请输入用户名：')
         await send(connection, {
             'type': 'init',
             'username': username
         })
         data = await recv(connection)
 
-        while True:
-            if data['type'] == 'empty_username':
-                print('用户名不可为空！请重新输入：')
-            elif data['type'] == 'duplicate_username':
-                print('已存在该用户名！请重新输入：')
+    assert data['type'] == 'online_success'
+    if interactive:
+        print('欢迎！' + username + '。当前在线人数：' + str(data['number_of_online_users']))
+    return username
+
+
+async def reconnect(urls):
+    """Try the cached ranking in order until a server accepts the connection."""
+    while True:
+        try:
+            return await server_selection.connect(urls, probe_first=False)
+        except ConnectionError:
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+
+async def main(urls, username=None, pipe=False):
+    connection, url = await server_selection.connect(urls)
+
+    stdin_queue = asyncio.Queue()
+    unsent = collections.deque()
+    if pipe:
+        background_tasks = [
+            asyncio.ensure_future(stdin_reader(stdin_queue)),
+            asyncio.ensure_future(pipe_flush_handler())
+        ]
+    else:
+        background_tasks = [asyncio.ensure_future(line_reader(stdin_queue))]
+
+    while True:
+        try:
+            if pipe:
+                username = await login(connection, username)
+                drained = asyncio.Event()
+                handlers = [
+                    asyncio.ensure_future(pipe_send_handler(connection, stdin_queue, unsent, drained)),
+                    asyncio.ensure_future(pipe_receive_handler(connection, drained))
+                ]
             else:
-                break
+                rtt = await server_selection.ping(connection)
+                print('已连接服务器 ' + url + '（延迟 ' + str(round(rtt * 1000)) + ' ms）')
+                username = await login(connection, username, stdin_queue)
+                handlers = [
+                    asyncio.ensure_future(send_handler(connection, username, stdin_queue)),
+                    asyncio.ensure_future(receive_handler(connection))
+                ]
 
-            username = await loop.run_in_executor(None, input, '请输入用户名：')
-            await send(connection, {
-                'type': 'init',
-                'username': username
-            })
-            data = await recv(connection)
+            done, pending = await asyncio.wait(handlers, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            # Once everything is broadcast, the pipe mode is done even if the connection closes at the same time
+            if not (pipe and drained.is_set()):
+                for task in done:
+                    task.result()
 
-        assert data['type'] == 'online_success'
-        print('欢迎！' + username + '。当前在线人数：' + str(data['number_of_online_users']))
+        except ConnectionClosed:
+            # Fail over to the next server of the cached ranking and log in again with the same username
+            print('与服务器的连接已断开，正在切换服务器…', file=sys.stderr if pipe else sys.stdout)
+            connection, url = await reconnect(urls)
+            continue
+        except EOFError:
+            # Stdin closed while asking for a username
+            pass
 
-        await asyncio.gather(
-            send_handler(connection, username),
-            receive_handler(connection)
-        )
+        # Finished at the end of the input
+        await connection.close()
+        for task in background_tasks:
+            task.cancel()
+        sys.stdout.buffer.flush()
+        return
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description='Simple Chat command line client.')
+    parser.add_argument('--server', action='append', dest='servers',
+                        help='server endpoint, may be repeated; the one with the lowest latency is used')
+    parser.add_argument('--username', default=None)
+    parser.add_argument('--pipe', action='store_true',
+                        help='send every line of stdin as a message and write received frames to stdout as JSON lines '
+                             '(requires --username)')
+    args = parser.parse_args()
+    if args.pipe and not args.username:
+        parser.error('--pipe requires --username')
+
+    asyncio.run(main(args.servers or server_selection.DEFAULT_ENDPOINTS, args.username, args.pipe))
@@ -1,34 +1,49 @@
 import asyncio
+import itertools
 import json
 import sys
 import time
 import typing
 
-import websockets
 from PyQt5.QtCore import QThread, pyqtSignal, Qt
 from PyQt5.QtGui import QCloseEvent, QIcon, QTextCursor, QFont, QColor
 from PyQt5.QtWidgets import QApplication, QMainWindow, QVBoxLayout, QWidget, QTextEdit, QLineEdit, QPushButton, \
-    QDialog, QMessageBox, QHBoxLayout, QSplitter
+    QDialog, QMessageBox, QHBoxLayout, QSplitter, QLabel
+from websockets.exceptions import ConnectionClosed
 
 import images
+import server_selection
+from history_cache import HistoryCache
 
+# Minimum interval in seconds between two typing notifications sent to the server
+TYPING_THROTTLE = 1.0
+# Interval in seconds between two latency measurements
+PING_INTERVAL = 5.0
+RECONNECT_INTERVAL = 1.0
 
-# TODO: 手动选择服务器
 
 class SimpleChatClient(QThread):
     show_username_dialog_signal = pyqtSignal()
     username_dialog_data_ready_signal = pyqtSignal(dict)
     main_window_data_ready_signal = pyqtSignal(dict)
 
-    def __init__(self, url):
+    def __init__(self, urls):
         super().__init__()
 
-        self.url = url
+        self.urls = urls
+        self.url = None
 
         self.connection = None
         self.username = None
         self.loop = None
         self.username_set_event = None
+        self.closing = False
+        self.failing_over = False
+
+        self.history_cache = HistoryCache.for_server(' '.join(sorted(urls)))
+        self.history_id = None
+
+        self.ping_times = dict()
 
     def set_username(self, username):
         self.loop.call_soon_threadsafe(asyncio.create_task, self.set_username_handler(username))
@@ -36,6 +51,9 @@ class SimpleChatClient(QThread):
     def send_message(self, message):
         self.loop.call_soon_threadsafe(asyncio.create_task, self.send_single_message_handler(message))
 
+    def send_typing(self):
+        self.loop.call_soon_threadsafe(asyncio.create_task, self.send({'type': 'typing'}))
+
     def close_connection(self):
         self.loop.call_soon_threadsafe(asyncio.create_task, self.close_connection_handler())
 
@@ -48,6 +66,14 @@ class SimpleChatClient(QThread):
     async def recv(self) -> dict:
         return json.loads(await self.connection.recv())
 
+    def init_message(self) -> dict:
+        return {
+            'type': 'init',
+            'username': self.username,
+            'history_id': self.history_cache.get('history_id'),
+            'last_seq': self.history_cache.last_seq()
+        }
+
     async def set_username_handler(self, username):
         assert self.username_set_event is not None
         self.username = username
@@ -57,23 +83,53 @@ class SimpleChatClient(QThread):
         await self.send({'type': 'chat', 'username': self.username, 'message': message})
 
     async def close_connection_handler(self):
+        self.closing = True
         await self.connection.close()
         self.loop.stop()
 
+    async def ping_handler(self):
+        for ping_id in itertools.count():
+            if not self.failing_over:
+                self.ping_times[ping_id] = time.perf_counter()
+                try:
+                    await self.send({'type': 'ping', 'id': ping_id})
+                except ConnectionClosed:
+                    del self.ping_times[ping_id]
+            await asyncio.sleep(PING_INTERVAL)
+
+    async def fail_over_handler(self):
+        self.main_window_data_ready_signal.emit({'type': 'disconnected'})
+        self.failing_over = True
+        self.ping_times.clear()
+        while True:
+            try:
+                # Try the cached ranking in order, then log in again with the same username
+                self.connection, self.url = await server_selection.connect(self.urls, probe_first=False)
+                await self.send(self.init_message())
+                data = await self.recv()
+                if data['type'] == 'online_success':
+                    break
+                # The previous session may still be registered, try again shortly
+                await self.connection.close()
+            except (ConnectionError, ConnectionClosed):
+                pass
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+        self.failing_over = False
+        self.history_id = data['history_id']
+        self.main_window_data_ready_signal.emit(data)
+
     async def main_handler(self):
-        self.connection = await websockets.connect(self.url, ping_interval=None)
+        self.loop = asyncio.get_event_loop()
+        self.connection, self.url = await server_selection.connect(self.urls)
 
         self.show_username_dialog_signal.emit()
 
         self.username_set_event = asyncio.Event()
-        self.loop = asyncio.get_event_loop()
 
         await self.username_set_event.wait()
 
-        await self.send({
-            'type': 'init',
-            'username': self.username
-        })
+        await self.send(self.init_message())
         data = await self.recv()
 
         while data['type'] != 'online_success':
@@ -82,28 +138,49 @@ class SimpleChatClient(QThread):
             self.username_set_event.clear()
             await self.username_set_event.wait()
 
-            await self.send({
-                'type': 'init',
-                'username': self.username
-            })
+            await self.send(self.init_message())
             data = await self.recv()
 
         assert data['type'] == 'online_success'
+        self.history_id = data['history_id']
+        self.history_cache.set('username', self.username)
         self.username_dialog_data_ready_signal.emit(data)
         self.main_window_data_ready_signal.emit(data)
 
+        asyncio.ensure_future(self.ping_handler())
         while True:
-            self.main_window_data_ready_signal.emit(await self.recv())
+            try:
+                data = await self.recv()
+            except ConnectionClosed:
+                if self.closing:
+                    return
+                await self.fail_over_handler()
+                continue
+
+            if data['type'] == 'pong':
+                t = self.ping_times.pop(data['id'], None)
+                if t is None:
+                    continue
+                data = {'type': 'latency', 'rtt': time.perf_counter() - t, 'url': self.url}
+            elif data['type'] == 'chat':
+                self.history_cache.add([data])
+            elif data['type'] == 'history':
+                if data['complete']:
+                    self.history_cache.reset(self.history_id)
+                self.history_cache.add(data['messages'])
+            self.main_window_data_ready_signal.emit(data)
 
     def run(self):
         asyncio.run(self.main_handler())
 
 
 class CustomTextEdit(QTextEdit):
-    def __init__(self, return_key_callback, *args, **kwargs):
+    def __init__(self, return_key_callback, typing_callback=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.return_key_callback = return_key_callback
+        self.typing_callback = typing_callback
+        self.last_typing_time = 0.0
 
     def keyPressEvent(self, event):
         if (event.key() == Qt.Key_Return or event.key() == Qt.Key_Enter) and \
@@ -112,6 +189,12 @@ class CustomTextEdit(QTextEdit):
         else:
             super().keyPressEvent(event)
 
+            # Notify at most once per TYPING_THROTTLE seconds, and only for keys that edit the text
+            if self.typing_callback is not None and (event.text() or event.key() == Qt.Key_Backspace) and \
+                    time.monotonic() - self.last_typing_time >= TYPING_THROTTLE:
+                self.last_typing_time = time.monotonic()
+                self.typing_callback()
+
 
 class UsernameDialog(QDialog):
     def __init__(self, simple_chat_client):
@@ -130,6 +213,7 @@ class UsernameDialog(QDialog):
             border-radius: 8px;
         ''')
         self.username_edit.setPlaceholderText('用户名')
+        self.username_edit.setText(self.simple_chat_client.history_cache.get('username') or '')
         layout.addWidget(self.username_edit)
 
         self.start_button = QPushButton('开始')
@@ -185,6 +269,15 @@ class UsernameDialog(QDialog):
         elif data['type'] == 'duplicate_username':
             QMessageBox.warning(self, '登录失败', '已存在该用户名！')
 
+        elif data['type'] == 'server_busy':
+            QMessageBox.warning(self, '登录失败', '服务器繁忙，请稍后再试！')
+
+        elif data['type'] == 'invalid_message':
+            if data['reason'] == 'username_too_long':
+                QMessageBox.warning(self, '登录失败', '用户名过长！')
+            else:
+                QMessageBox.warning(self, '登录失败', '用户名无效！')
+
         else:
             raise Exception('unexpected data received')
 
@@ -201,6 +294,9 @@ class MainWindow(QMainWindow):
 
         self.number_of_online_users = 0
 
+        self.latency_label = QLabel()
+        self.statusBar().addPermanentWidget(self.latency_label)
+
         central_widget = QWidget()
         self.setCentralWidget(central_widget)
 
@@ -245,7 +341,7 @@ class MainWindow(QMainWindow):
         ''')
         splitter.addWidget(self.chat_box_text_edit)
 
-        self.message_edit = CustomTextEdit(self.send_message)
+        self.message_edit = CustomTextEdit(self.send_message, self.simple_chat_client.send_typing)
         self.message_edit.setAcceptRichText(False)
         self.message_edit.setStyleSheet(
             self.chat_box_text_edit.styleSheet())
@@ -292,6 +388,11 @@ class MainWindow(QMainWindow):
 
         self.message_edit.setFocus()
 
+        # Render cached messages right away instead of waiting for the server
+        cached_username = self.simple_chat_client.history_cache.get('username')
+        for data in self.simple_chat_client.history_cache.load_recent():
+            self.display_chat(data, cached_username)
+
     def send_message(self):
         message = self.message_edit.toPlainText()
         if not message:
@@ -299,17 +400,17 @@ class MainWindow(QMainWindow):
             return
         self.simple_chat_client.send_message(message)
         self.message_edit.clear()
+        self.message_edit.last_typing_time = 0.0
 
     def on_data_received(self, data):
         if data['type'] == 'chat':
+            self.display_chat(data, self.simple_chat_client.username)
 
-            text = data['username'] + ' [' + \
-                   time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(data['timestamp'])) + ']: '
-            if data['username'] == self.simple_chat_client.username:
-                self.display_self_message_header(text)
-            else:
-                self.display_message_header(text)
-            self.display_message_body(data['message'])
+        elif data['type'] == 'history':
+            if data['complete']:
+                self.chat_box_text_edit.clear()
+            for message in data['messages']:
+                self.display_chat(message, self.simple_chat_client.username)
 
         elif data['type'] == 'user_online':
             self.display_notification('用户' + data['username'] + '已上线')
@@ -321,6 +422,29 @@ class MainWindow(QMainWindow):
             self.number_of_online_users -= 1
             self.setWindowTitle('Simple Chat - 当前在线人数：' + str(self.number_of_online_users))
 
+        elif data['type'] == 'invalid_message':
+            if data['reason'] == 'message_too_long':
+                self.display_notification('消息过长，发送失败')
+            elif data['reason'] == 'message_blocked':
+                self.display_notification('消息包含违禁词，发送失败')
+            else:
+                self.display_notification('消息无效，发送失败')
+
+        elif data['type'] == 'typing':
+            usernames = [username for username in data['usernames'] if username != self.simple_chat_client.username]
+            if usernames:
+                self.statusBar().showMessage('、'.join(usernames) + ' 正在输入…')
+            else:
+                self.statusBar().clearMessage()
+
+        elif data['type'] == 'latency':
+            self.latency_label.setText('延迟：' + str(round(data['rtt'] * 1000)) + ' ms')
+            self.latency_label.setToolTip(data['url'])
+
+        elif data['type'] == 'disconnected':
+            self.display_notification('与服务器的连接已断开，正在切换服务器…')
+            self.latency_label.clear()
+
         elif data['type'] == 'online_success':
             # self.display_notification(
             #     self.simple_chat_client.username + '，欢迎！当前在线人数：' + str(data['number_of_online_users'])
@@ -331,6 +455,15 @@ class MainWindow(QMainWindow):
         else:
             raise Exception('unexpected data received')
 
+    def display_chat(self, data, self_username):
+        text = data['username'] + ' [' + \
+               time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(data['timestamp'])) + ']: '
+        if data['username'] == self_username:
+            self.display_self_message_header(text)
+        else:
+            self.display_message_header(text)
+        self.display_message_body(data['message'])
+
     def display_message_header(self, text):
         self.append_text(text, font_point_size=7.5, font_weight=QFont.Bold, text_color=QColor(0, 0, 160))
 
@@ -370,7 +503,9 @@ if __name__ == '__main__':
     QApplication.setAttribute(Qt.AA_EnableHighDpiScaling)
     app = QApplication(sys.argv)
 
-    simple_chat_client = SimpleChatClient('ws://127.0.0.1:34999/')
+    # Server endpoints may be given on the command line, the one with the lowest latency is used
+    urls = [arg for arg in sys.argv[1:] if arg.startswith(('ws://', 'wss://'))]
+    simple_chat_client = SimpleChatClient(urls or server_selection.DEFAULT_ENDPOINTS)
     username_dialog = UsernameDialog(simple_chat_client)
     main_window = MainWindow(simple_chat_client)
 
@@ -0,0 +1,398 @@
+import argparse
+import asyncio
+import bisect
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import secrets
+import socket
+import subprocess
+import sys
+import time
+
+import websockets
+from loguru import logger
+from websockets.exceptions import ConnectionClosed, WebSocketException
+
+import messages
+
+# Events queued for a peer are coalesced for this many seconds before being sent as one batch
+BATCH_INTERVAL = 0.005
+# An empty batch is sent at least this often so that peers keep an up-to-date session count
+HEARTBEAT_INTERVAL = 5.0
+CLAIM_TIMEOUT = 5.0
+RECONNECT_INTERVAL = 1.0
+# Batches are split to stay below this encoded size. A batch holding a single event is at most one client frame larger.
+MAX_BATCH_SIZE = 1 << 20
+MAX_LINK_FRAME_SIZE = MAX_BATCH_SIZE + messages.MAX_FRAME_SIZE
+
+# Nodes authenticate their links with a shared secret taken from this environment variable
+SECRET_ENVIRONMENT_VARIABLE = 'SIMPLE_CHAT_CLUSTER_SECRET'
+NODE_HEADER = 'X-Cluster-Node'
+SECRET_HEADER = 'X-Cluster-Secret'
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hash ring with virtual nodes. Adding or removing a node only moves the keys adjacent to it."""
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.nodes = set()
+        self._hashes = []
+        self._owners = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node: str) -> None:
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.replicas):
+            h = _hash(node + '#' + str(i))
+            index = bisect.bisect(self._hashes, h)
+            self._hashes.insert(index, h)
+            self._owners.insert(index, node)
+
+    def remove(self, node: str) -> None:
+        if node not in self.nodes:
+            return
+        self.nodes.remove(node)
+        kept = [(h, owner) for h, owner in zip(self._hashes, self._owners) if owner != node]
+        self._hashes = [h for h, _ in kept]
+        self._owners = [owner for _, owner in kept]
+
+    def owner(self, key: str) -> str:
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+
+def validate_event(event) -> dict:
+    """Return a copy of a forwarded chat or presence event holding only the known fields, or raise ValueError."""
+    if type(event) is not dict:
+        raise ValueError('forwarded event is not an object')
+    event_type = event.get('type')
+    username = event.get('username')
+    if event_type not in ('chat', 'user_online', 'user_offline') or type(username) is not str or not username or \
+            len(username) > messages.MAX_USERNAME_LENGTH or type(event.get('timestamp')) is not int:
+        raise ValueError('invalid forwarded event')
+
+    validated = {'type': event_type, 'username': username}
+    if event_type == 'chat':
+        message = event.get('message')
+        if type(message) is not str or not message or len(message) > messages.MAX_MESSAGE_LENGTH:
+            raise ValueError('invalid forwarded chat message')
+        validated['message'] = message
+    validated['timestamp'] = event['timestamp']
+    return validated
+
+
+class PeerLink:
+    """Persistent outbound link to one peer node. Queued events are sent in batches."""
+
+    def __init__(self, cluster, node):
+        self.cluster = cluster
+        self.node = node
+
+        self.queue = []
+        self.queue_event = asyncio.Event()
+        self.connected = False
+
+    def enqueue(self, event: dict) -> None:
+        if self.connected:
+            self.queue.append(event)
+            self.queue_event.set()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                async with websockets.connect('ws://' + self.node + '/', ping_interval=None, additional_headers={
+                    NODE_HEADER: self.cluster.node,
+                    SECRET_HEADER: self.cluster.secret
+                }) as connection:
+                    self.connected = True
+                    self.cluster.on_link_up(self.node)
+                    await self.flush_forever(connection)
+            except (OSError, asyncio.TimeoutError, WebSocketException) as e:
+                if self.connected:
+                    logger.warning('Link to node [' + self.node + '] lost: ' + str(e))
+            finally:
+                if self.connected:
+                    self.connected = False
+                    self.queue.clear()
+                    self.cluster.on_link_down(self.node)
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+    async def flush_forever(self, connection) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.queue_event.wait(), HEARTBEAT_INTERVAL)
+                await asyncio.sleep(BATCH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            events, self.queue = self.queue, []
+            self.queue_event.clear()
+            for frame in self.encode(events):
+                await connection.send(frame)
+
+    def encode(self, events) -> list:
+        """Encode a batch of events into frames, halving it until every frame is below MAX_BATCH_SIZE."""
+        frame = json.dumps({
+            'node': self.cluster.node,
+            'sessions': len(self.cluster.local_owners),
+            'events': events
+        })
+        if len(frame) <= MAX_BATCH_SIZE or len(events) <= 1:
+            return [frame]
+        half = len(events) // 2
+        return self.encode(events[:half]) + self.encode(events[half:])
+
+
+class Cluster:
+    """
+    Membership, username ownership and event forwarding for one server node.
+
+    Every username is owned by the node chosen by the hash ring. The owner keeps a record of which node holds the
+    session, so the duplicate username check stays correct across the cluster. Chat and presence events are forwarded
+    to all peers over batched links and handed to `on_event` on arrival.
+    """
+
+    def __init__(self, node, peers, on_event, secret):
+        self.node = node
+        self.on_event = on_event
+        self.secret = secret
+
+        self.ring = HashRing([node])
+        self.links = {peer: PeerLink(self, peer) for peer in peers if peer != node}
+        self.link_tasks = []
+        # Addresses from which each peer may connect, resolved once at startup
+        self.peer_addresses = {peer: self.resolve(peer) for peer in self.links}
+
+        # Usernames owned by this node -> node holding the session
+        self.owned_usernames = dict()
+        # Usernames logged in on this node -> node that granted the claim
+        self.local_owners = dict()
+        # Number of sessions held by each peer, as reported in its last batch
+        self.session_counts = dict()
+        # Usernames online at each peer, learned from forwarded presence events on the current link from that peer
+        self.remote_usernames = dict()
+
+        self.pending_claims = dict()
+        self.claim_ids = itertools.count()
+
+    @staticmethod
+    def resolve(node: str) -> set:
+        try:
+            return {info[4][0] for info in socket.getaddrinfo(node.rsplit(':', 1)[0], None)}
+        except OSError as e:
+            logger.warning('Failed to resolve node [' + node + ']: ' + str(e))
+            return set()
+
+    def process_request(self, connection, request):
+        """Reject the handshake unless it comes from a configured peer that knows the shared secret."""
+        node = request.headers.get(NODE_HEADER)
+        secret = request.headers.get(SECRET_HEADER, '')
+        if node not in self.links or not hmac.compare_digest(secret.encode(), self.secret.encode()) or \
+                connection.remote_address[0] not in self.peer_addresses[node]:
+            logger.warning('Rejected a cluster link from [' + connection.remote_address[0] + '] claiming to be node [' +
+                           str(node) + '].')
+            return connection.respond(403, 'Forbidden\n')
+        return None
+
+    def start(self) -> None:
+        self.link_tasks = [asyncio.ensure_future(link.run()) for link in self.links.values()]
+
+    def stop(self) -> None:
+        for task in self.link_tasks:
+            task.cancel()
+
+    def number_of_remote_sessions(self) -> int:
+        return sum(self.session_counts.values())
+
+    def send_to(self, node: str, event: dict) -> None:
+        self.links[node].enqueue(event)
+
+    def forward(self, event: dict) -> None:
+        wrapped = {'type': 'event', 'event': event}
+        for link in self.links.values():
+            link.enqueue(wrapped)
+
+    async def claim(self, username: str) -> bool:
+        owner = self.ring.owner(username)
+        if owner == self.node:
+            ok = self.claim_locally(username, self.node)
+        else:
+            claim_id = next(self.claim_ids)
+            future = asyncio.get_event_loop().create_future()
+            self.pending_claims[claim_id] = future
+            self.send_to(owner, {'type': 'claim', 'id': claim_id, 'username': username})
+            try:
+                ok = await asyncio.wait_for(future, CLAIM_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning('Claim of username (' + username + ') timed out at node [' + owner + '].')
+                ok = False
+            except asyncio.CancelledError:
+                ok = False
+                raise
+            finally:
+                del self.pending_claims[claim_id]
+                # An unanswered claim may still be granted, and a granted one may be abandoned by a cancelled login.
+                # Release it so the username does not stay taken. Links deliver in order, so the release arrives after
+                # the claim.
+                answered = future.done() and not future.cancelled()
+                if not ok and (not answered or future.result()):
+                    self.send_to(owner, {'type': 'release', 'username': username})
+        if ok:
+            self.local_owners[username] = owner
+        return ok
+
+    def claim_locally(self, username: str, holder: str) -> bool:
+        if username in self.owned_usernames:
+            return False
+        self.owned_usernames[username] = holder
+        return True
+
+    def release(self, username: str) -> None:
+        owner = self.local_owners.pop(username, None)
+        if owner == self.node:
+            self.owned_usernames.pop(username, None)
+        elif owner is not None and owner in self.ring.nodes:
+            self.send_to(owner, {'type': 'release', 'username': username})
+
+    def rebalance(self) -> None:
+        # Drop records that now belong to another node; their holders re-register them there
+        for username in [username for username in self.owned_usernames if self.ring.owner(username) != self.node]:
+            del self.owned_usernames[username]
+
+        # Re-register only the local sessions whose owner changed
+        for username, old_owner in list(self.local_owners.items()):
+            owner = self.ring.owner(username)
+            if owner == old_owner:
+                continue
+            self.local_owners[username] = owner
+            if owner == self.node:
+                self.register_locally(username, self.node)
+            else:
+                self.send_to(owner, {'type': 'register', 'username': username})
+
+    def register_locally(self, username: str, holder: str) -> None:
+        if self.owned_usernames.setdefault(username, holder) != holder:
+            logger.warning('Username (' + username + ') is held by both [' + self.owned_usernames[username] +
+                           '] and [' + holder + '].')
+
+    def on_link_up(self, node: str) -> None:
+        logger.info('Node [' + node + '] joined the cluster.')
+        self.ring.add(node)
+        self.rebalance()
+
+        # The peer forgot the local users when the link dropped, or never knew them, so announce them again
+        timestamp = int(time.time())
+        for username in self.local_owners:
+            self.send_to(node, {
+                'type': 'event',
+                'event': {'type': 'user_online', 'username': username, 'timestamp': timestamp}
+            })
+
+    def on_link_down(self, node: str) -> None:
+        logger.info('Node [' + node + '] left the cluster.')
+        self.ring.remove(node)
+        self.rebalance()
+
+    async def peer_handler(self, connection) -> None:
+        # Authenticated by `process_request`
+        node = connection.request.headers[NODE_HEADER]
+        usernames = self.remote_usernames[node] = set()
+        try:
+            async for frame in connection:
+                batch = json.loads(frame)
+                sessions = batch['sessions']
+                if type(sessions) is not int or sessions < 0:
+                    raise ValueError('invalid session count')
+                self.session_counts[node] = sessions
+                for event in batch['events']:
+                    await self.handle(node, event, usernames)
+        except ConnectionClosed:
+            pass
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning('Closing the link from node [' + node + '] after a malformed frame: ' + repr(e))
+            await connection.close(1008, 'malformed frame')
+        finally:
+            # The peer's sessions are gone with its link; it re-registers them when the link comes back
+            self.session_counts.pop(node, None)
+            for username in [username for username, holder in self.owned_usernames.items() if holder == node]:
+                del self.owned_usernames[username]
+
+            # Local users only see presence events, so tell them that the peer's users are gone. A newer link from
+            # the same peer takes over the users it has announced again already.
+            newer_usernames = self.remote_usernames.get(node)
+            if newer_usernames is usernames:
+                del self.remote_usernames[node]
+                newer_usernames = set()
+            timestamp = int(time.time())
+            for username in sorted(usernames - newer_usernames):
+                await self.on_event({'type': 'user_offline', 'username': username, 'timestamp': timestamp})
+
+    async def handle(self, node: str, event: dict, usernames: set) -> None:
+        if event['type'] in ('claim', 'release', 'register') and type(event['username']) is not str:
+            raise ValueError('invalid username')
+
+        if event['type'] == 'event':
+            event = validate_event(event['event'])
+            # Presence events are delivered once per user, so that announcements repeated on link up are ignored
+            if event['type'] == 'user_online':
+                if event['username'] in usernames:
+                    return
+                usernames.add(event['username'])
+            elif event['type'] == 'user_offline':
+                if event['username'] not in usernames:
+                    return
+                usernames.remove(event['username'])
+            await self.on_event(event)
+        elif event['type'] == 'claim':
+            ok = self.ring.owner(event['username']) == self.node and \
+                 self.claim_locally(event['username'], node)
+            if node in self.links:
+                self.send_to(node, {'type': 'claim_result', 'id': event['id'], 'ok': ok})
+        elif event['type'] == 'claim_result':
+            future = self.pending_claims.get(event['id'])
+            if future is not None and not future.done():
+                future.set_result(event['ok'])
+        elif event['type'] == 'release':
+            if self.owned_usernames.get(event['username']) == node:
+                del self.owned_usernames[event['username']]
+        elif event['type'] == 'register':
+            self.register_locally(event['username'], node)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local cluster of server nodes on consecutive ports.')
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--port', type=int, default=34999, help='client port of the first node')
+    parser.add_argument('--cluster-port', type=int, default=35999, help='cluster port of the first node')
+    args = parser.parse_args()
+
+    addresses = ['127.0.0.1:' + str(args.cluster_port + i) for i in range(args.nodes)]
+    # A fresh secret for this local cluster, passed in the environment rather than on the command line
+    environment = dict(os.environ)
+    environment.setdefault(SECRET_ENVIRONMENT_VARIABLE, secrets.token_hex(16))
+    processes = [
+        subprocess.Popen([
+            sys.executable, 'server.py',
+            '--port', str(args.port + i),
+            '--cluster-port', str(args.cluster_port + i),
+            '--node-address', addresses[i],
+            '--peers', *addresses
+        ], env=environment)
+        for i in range(args.nodes)
+    ]
+    try:
+        for process in processes:
+            process.wait()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
@@ -0,0 +1,65 @@
+import hashlib
+import os
+import sqlite3
+
+CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.simple_chat')
+CACHE_SIZE = 500
+
+
+class HistoryCache:
+    """
+    Local store of recently seen chat messages keyed by their sequence number on the server.
+
+    Lets the client render the chat window before connecting and ask the server only for newer messages.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS messages ('
+                                'seq INTEGER PRIMARY KEY, username TEXT, message TEXT, timestamp INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.commit()
+
+    @classmethod
+    def for_server(cls, url):
+        os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+        return cls(os.path.join(CACHE_DIRECTORY, hashlib.md5(url.encode()).hexdigest() + '.sqlite3'))
+
+    def get(self, key):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+        self.connection.commit()
+
+    def last_seq(self):
+        return self.connection.execute('SELECT MAX(seq) FROM messages').fetchone()[0]
+
+    def load_recent(self, limit=CACHE_SIZE) -> list:
+        rows = self.connection.execute('SELECT seq, username, message, timestamp FROM messages '
+                                       'ORDER BY seq DESC LIMIT ?', (limit,)).fetchall()
+        return [
+            {'type': 'chat', 'seq': seq, 'username': username, 'message': message, 'timestamp': timestamp}
+            for seq, username, message, timestamp in reversed(rows)
+        ]
+
+    def add(self, messages) -> None:
+        self.connection.executemany(
+            'INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?)',
+            [(data['seq'], data['username'], data['message'], data['timestamp']) for data in messages]
+        )
+        self.connection.execute('DELETE FROM messages WHERE seq <= (SELECT MAX(seq) FROM messages) - ?',
+                                (CACHE_SIZE,))
+        self.connection.commit()
+
+    def reset(self, history_id) -> None:
+        """Drop messages from another sequence space, e.g. after the server restarted."""
+        self.connection.execute('DELETE FROM messages')
+        self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('history_id', history_id))
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
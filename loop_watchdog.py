@@ -0,0 +1,71 @@
+import asyncio
+import bisect
+import sys
+import threading
+import time
+import traceback
+
+from loguru import logger
+
+# Upper bounds in seconds of the stall duration histogram buckets, the last bucket is unbounded
+STALL_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LoopWatchdog:
+    """
+    Detects stalls of an asyncio event loop from a separate thread.
+
+    A heartbeat task on the loop records when it last ran. If the heartbeat is late by more than `threshold` seconds,
+    the watchdog thread logs the stack of the loop thread, which shows the callback that is blocking it. Stall durations
+    are collected in a histogram that is logged every `report_interval` seconds if anything stalled.
+    """
+
+    def __init__(self, threshold=0.1, interval=0.05, report_interval=600.0):
+        self.threshold = threshold
+        self.interval = interval
+        self.report_interval = report_interval
+
+        self.loop_thread_id = None
+        self.last_beat = time.monotonic()
+        self.reported_beat = None
+
+        self.histogram = [0] * (len(STALL_BUCKETS) + 1)
+        self.longest_stall = 0.0
+        self.stopped = threading.Event()
+
+    async def heartbeat(self) -> None:
+        self.loop_thread_id = threading.get_ident()
+        threading.Thread(target=self.watch, name='loop-watchdog', daemon=True).start()
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                stall = now - self.last_beat - self.interval
+                self.last_beat = now
+                if stall >= self.threshold:
+                    self.histogram[bisect.bisect_left(STALL_BUCKETS, stall)] += 1
+                    self.longest_stall = max(self.longest_stall, stall)
+        finally:
+            self.stopped.set()
+
+    def watch(self) -> None:
+        next_report = time.monotonic() + self.report_interval
+        while not self.stopped.wait(self.interval):
+            now = time.monotonic()
+            last_beat = self.last_beat
+            if now - last_beat - self.interval >= self.threshold and last_beat != self.reported_beat:
+                # Report each stall once, while it is still going on
+                self.reported_beat = last_beat
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is not None:
+                    logger.warning('Event loop blocked for more than ' + str(round(now - last_beat, 3)) +
+                                   ' seconds in:\n' + ''.join(traceback.format_stack(frame)))
+            if now >= next_report:
+                next_report = now + self.report_interval
+                if any(self.histogram):
+                    logger.info('Event loop stalls: ' + self.summary())
+
+    def summary(self) -> str:
+        bounds = ['<=' + str(bound) + 's' for bound in STALL_BUCKETS] + ['>' + str(STALL_BUCKETS[-1]) + 's']
+        return ', '.join(bound + ': ' + str(count) for bound, count in zip(bounds, self.histogram)) + \
+            ' (longest ' + str(round(self.longest_stall, 3)) + 's)'
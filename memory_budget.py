@@ -0,0 +1,117 @@
+import asyncio
+
+from loguru import logger
+
+# Rough size of the per-connection state that is not buffered data: protocol objects, parser buffers and metadata
+SESSION_OVERHEAD = 16 << 10
+# Write buffer limits of the websockets library, and the limit applied to every connection while memory is short
+DEFAULT_WRITE_LIMIT = 32 << 10
+REDUCED_WRITE_LIMIT = 4 << 10
+# Above this fraction of the budget write buffers are reduced, and new connections and logins refused
+SOFT_LIMIT_RATIO = 0.75
+CHECK_INTERVAL = 1.0
+REPORT_INTERVAL = 60.0
+
+
+def session_bytes(connection) -> int:
+    """Estimate the memory held by a websocket connection: buffered outgoing data, queued incoming frames, overhead."""
+    size = SESSION_OVERHEAD
+    transport = getattr(connection, 'transport', None)
+    if transport is not None:
+        size += transport.get_write_buffer_size()
+    recv_messages = getattr(connection, 'recv_messages', None)
+    if recv_messages is not None:
+        size += sum(len(frame.data) for frame in recv_messages.frames.queue)
+    return size
+
+
+def format_bytes(size) -> str:
+    return str(round(size / (1 << 20), 1)) + ' MiB'
+
+
+class MemoryBudget:
+    """
+    Accounts the approximate memory of every accepted connection plus shared state, and keeps the total within `limit`
+    bytes.
+
+    Above the soft limit the write buffer limits of all connections are reduced, so that broadcasts to slow clients
+    apply backpressure sooner, `process_request` rejects new handshakes and `admit` refuses logins on connections that
+    were already accepted. Above `limit` the sessions holding the most memory are disconnected until the total is back
+    below the soft limit.
+    """
+
+    def __init__(self, limit, connections, shared_bytes=lambda: 0):
+        self.limit = limit
+        self.soft_limit = int(limit * SOFT_LIMIT_RATIO)
+        self.connections = connections
+        self.shared_bytes = shared_bytes
+
+        self.total = 0
+        self.largest = 0
+        self.reduced = False
+        self.shed_sessions = 0
+        self.refused_logins = 0
+        self.refused_handshakes = 0
+
+    def process_request(self, connection, request):
+        """Handshake hook of `websockets.serve`, answering 503 instead of accepting a connection above the soft limit."""
+        if self.total >= self.soft_limit:
+            self.refused_handshakes += 1
+            return connection.respond(503, 'Server busy\n')
+        # Counted until the next check measures it, so that a burst of handshakes cannot overshoot the budget
+        self.total += SESSION_OVERHEAD
+        return None
+
+    def admit(self) -> bool:
+        if self.total < self.soft_limit:
+            return True
+        self.refused_logins += 1
+        return False
+
+    def check(self) -> None:
+        sizes = {connection: session_bytes(connection) for connection in self.connections}
+        self.total = sum(sizes.values()) + self.shared_bytes()
+        self.largest = max(sizes.values(), default=0)
+
+        # Reduce the write buffers under pressure, and restore them once usage is well below the soft limit
+        if not self.reduced and self.total >= self.soft_limit:
+            self.reduced = True
+            logger.warning('Memory usage ' + format_bytes(self.total) + ' above the soft limit of ' +
+                           format_bytes(self.soft_limit) + ', reducing write buffers and refusing new connections.')
+        elif self.reduced and self.total < self.soft_limit // 2:
+            self.reduced = False
+            logger.info('Memory usage back to ' + format_bytes(self.total) + ', restoring write buffers.')
+        write_limit = REDUCED_WRITE_LIMIT if self.reduced else DEFAULT_WRITE_LIMIT
+        for connection in sizes:
+            transport = getattr(connection, 'transport', None)
+            if transport is not None and transport.get_write_buffer_limits()[1] != write_limit:
+                transport.set_write_buffer_limits(write_limit)
+
+        if self.total > self.limit:
+            for connection in sorted(sizes, key=sizes.get, reverse=True):
+                # Sessions without much buffered data are kept, dropping them would free next to nothing
+                if self.total < self.soft_limit or sizes[connection] <= SESSION_OVERHEAD + REDUCED_WRITE_LIMIT:
+                    break
+                # Aborting drops the buffers at once, a closing handshake would wait behind them
+                logger.warning('Disconnecting [' + str(connection.remote_address) + '] holding ' +
+                               format_bytes(sizes[connection]) + ' to stay within the memory budget.')
+                connection.transport.abort()
+                self.total -= sizes[connection]
+                self.shed_sessions += 1
+
+    def summary(self) -> str:
+        return str(len(self.connections)) + ' sessions, ' + format_bytes(self.total) + ' of ' + \
+            format_bytes(self.limit) + ' (largest session ' + format_bytes(self.largest) + ', ' + \
+            str(self.shed_sessions) + ' sessions shed, ' + str(self.refused_handshakes) + ' connections and ' + \
+            str(self.refused_logins) + ' logins refused)'
+
+    async def enforce_forever(self) -> None:
+        """Check the budget every CHECK_INTERVAL seconds and log the totals every REPORT_INTERVAL seconds."""
+        loop = asyncio.get_event_loop()
+        next_report = loop.time() + REPORT_INTERVAL
+        while True:
+            await asyncio.sleep(CHECK_INTERVAL)
+            self.check()
+            if loop.time() >= next_report:
+                next_report = loop.time() + REPORT_INTERVAL
+                logger.info('Memory: ' + self.summary())
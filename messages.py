@@ -0,0 +1,114 @@
+import json
+import typing
+
+MAX_USERNAME_LENGTH = 32
+MAX_MESSAGE_LENGTH = 4096
+# Every valid message must fit in a frame. With the default `ensure_ascii` of `json.dumps` a character takes up to 12
+# bytes on the wire (a \uXXXX surrogate pair), plus room for the envelope and the username.
+MAX_FRAME_SIZE = MAX_MESSAGE_LENGTH * 12 + 1024
+
+_json_decode = json.JSONDecoder().decode
+
+
+class MessageError(Exception):
+    """Raised when an inbound frame does not match the message schema. `reason` is sent back to the client."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+    def to_dict(self) -> dict:
+        return {'type': 'invalid_message', 'reason': self.reason}
+
+
+class InitMessage:
+    __slots__ = ('username', 'history_id', 'last_seq')
+
+    def __init__(self, username, history_id=None, last_seq=None):
+        self.username = username
+        self.history_id = history_id
+        self.last_seq = last_seq
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        username = data.get('username')
+        if type(username) is not str:
+            raise MessageError('invalid_username')
+        if len(username) > MAX_USERNAME_LENGTH:
+            raise MessageError('username_too_long')
+
+        # Optional position of the client's local history cache
+        history_id = data.get('history_id')
+        last_seq = data.get('last_seq')
+        if history_id is not None and type(history_id) is not str or \
+                last_seq is not None and type(last_seq) is not int:
+            raise MessageError('invalid_history_position')
+        return cls(username, history_id, last_seq)
+
+
+class ChatMessage:
+    __slots__ = ('message',)
+
+    def __init__(self, message):
+        self.message = message
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        message = data.get('message')
+        if type(message) is not str:
+            raise MessageError('invalid_message_body')
+        if len(message) > MAX_MESSAGE_LENGTH:
+            raise MessageError('message_too_long')
+        return cls(message)
+
+
+class TypingMessage:
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls()
+
+
+class PingMessage:
+    __slots__ = ('id',)
+
+    def __init__(self, ping_id):
+        self.id = ping_id
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        ping_id = data.get('id')
+        if type(ping_id) is not int:
+            raise MessageError('invalid_ping_id')
+        return cls(ping_id)
+
+
+_decoders = {
+    'init': InitMessage.from_dict,
+    'chat': ChatMessage.from_dict,
+    'typing': TypingMessage.from_dict,
+    'ping': PingMessage.from_dict,
+}
+
+
+def decode(frame: typing.Union[str, bytes]):
+    if len(frame) > MAX_FRAME_SIZE:
+        raise MessageError('frame_too_large')
+    if type(frame) is bytes:
+        try:
+            frame = frame.decode()
+        except UnicodeDecodeError:
+            raise MessageError('malformed_frame')
+    try:
+        data = _json_decode(frame)
+    except ValueError:
+        raise MessageError('malformed_frame')
+    if type(data) is not dict:
+        raise MessageError('malformed_frame')
+
+    message_type = data.get('type')
+    decoder = _decoders.get(message_type) if type(message_type) is str else None
+    if decoder is None:
+        raise MessageError('unknown_type')
+    return decoder(data)
@@ -0,0 +1,136 @@
+import asyncio
+import os
+import typing
+
+from loguru import logger
+
+MASK = 'mask'
+DROP = 'drop'
+FLAG = 'flag'
+ACTIONS = (MASK, DROP, FLAG)
+
+RELOAD_INTERVAL = 5.0
+
+
+class Automaton:
+    """
+    Aho-Corasick automaton over a set of banned words.
+
+    Matching is case-insensitive for Latin text and works per character, so Chinese words need no segmentation.
+    """
+
+    def __init__(self, words):
+        # Node 0 is the root. For every node: transitions, failure link, and the length of the longest word ending
+        # here (including words reachable through failure links), 0 if none.
+        self.goto = [dict()]
+        self.fail = [0]
+        self.match_length = [0]
+
+        for word in words:
+            word = word.lower()
+            if not word:
+                continue
+            node = 0
+            for char in word:
+                next_node = self.goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][char] = next_node
+                    self.goto.append(dict())
+                    self.fail.append(0)
+                    self.match_length.append(0)
+                node = next_node
+            self.match_length[node] = max(self.match_length[node], len(word))
+
+        # Breadth-first construction of failure links
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, next_node in self.goto[node].items():
+                queue.append(next_node)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_node] = self.goto[fallback].get(char, 0)
+                self.match_length[next_node] = max(self.match_length[next_node],
+                                                   self.match_length[self.fail[next_node]])
+
+        self.first_chars = frozenset(self.goto[0])
+
+    def find(self, text: str) -> list:
+        """Return the (start, end) spans of the longest banned word ending at each position of `text`."""
+        folded = text.lower()
+        if len(folded) != len(text):
+            folded = ''.join(char if len(char.lower()) != 1 else char.lower() for char in text)
+
+        # Most messages contain no character that can start a banned word
+        if self.first_chars.isdisjoint(folded):
+            return []
+
+        goto, fail, match_length = self.goto, self.fail, self.match_length
+        spans = []
+        node = 0
+        for i, char in enumerate(folded):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if match_length[node]:
+                spans.append((i + 1 - match_length[node], i + 1))
+        return spans
+
+
+def mask(text: str, spans) -> str:
+    chars = list(text)
+    for start, end in spans:
+        chars[start:end] = '*' * (end - start)
+    return ''.join(chars)
+
+
+def load_words(path) -> list:
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+class Moderator:
+    """Applies the configured action to chat messages containing banned words from a hot-reloadable word list."""
+
+    def __init__(self, path, action=MASK):
+        if action not in ACTIONS:
+            raise ValueError('unknown moderation action: ' + action)
+        self.path = path
+        self.action = action
+
+        self.mtime = os.stat(path).st_mtime
+        self.automaton = Automaton(load_words(path))
+
+    def moderate(self, username: str, text: str) -> typing.Optional[str]:
+        """Return the text to broadcast, or None if the message is dropped."""
+        spans = self.automaton.find(text)
+        if not spans:
+            return text
+        if self.action == MASK:
+            return mask(text, spans)
+        if self.action == DROP:
+            return None
+        logger.warning('Message from (' + username + ') flagged: ' + text)
+        return text
+
+    async def watch(self) -> None:
+        """Rebuild the automaton in a worker thread whenever the word list changes, then swap it in."""
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(RELOAD_INTERVAL)
+            try:
+                mtime = (await loop.run_in_executor(None, os.stat, self.path)).st_mtime
+                if mtime == self.mtime:
+                    continue
+                words = await loop.run_in_executor(None, load_words, self.path)
+                self.automaton = await loop.run_in_executor(None, Automaton, words)
+                self.mtime = mtime
+                logger.info('Reloaded ' + str(len(words)) + ' banned words from [' + self.path + '].')
+            except OSError as e:
+                logger.warning('Failed to reload banned words: ' + str(e))
+            except ValueError as e:
+                # For example a list saved in another encoding. Keep the current automaton, and only try again once
+                # the file changes.
+                self.mtime = mtime
+                logger.warning('Failed to reload banned words, keeping the previous list: ' + str(e))
@@ -1,12 +1,26 @@
+import argparse
 import asyncio
+import collections
 import json
+import os
+import signal
+import sys
 import time
 import typing
+import uuid
 from loguru import logger
 
 import websockets
 from websockets.exceptions import ConnectionClosed, WebSocketException
 
+import capture
+import cluster as cluster_module
+from chat_log import ChatLog
+from memory_budget import MemoryBudget
+import messages
+import moderation
+from loop_watchdog import LoopWatchdog
+
 
 # TODO: 将客户端传入的连接封装为类
 
@@ -50,16 +64,117 @@ def print_execution_time(ending_msg=''):
 
 connections = dict()
 username_to_connection = dict()
+# Every connection from the moment its handler is entered, logged in or not, so that the memory budget covers them all
+accepted_connections = set()
+
+# Typing state is aggregated here and broadcast by a single shared timer, see `typing_broadcaster`
+TYPING_INTERVAL = 1.0
+TYPING_TIMEOUT = 3.0
+typing_deadlines = dict()
+
+# Recent chat messages, numbered by `seq`. `history_id` identifies the sequence space of this process, or of the chat
+# log if there is one, so that clients can tell whether their cached sequence numbers are still meaningful.
+HISTORY_SIZE = 1000
+# Clients further behind than the in-memory history catch up from the chat log, up to this many messages
+MAX_CATCH_UP = 5000
+# Encoded size of a history frame, with a wide margin below the 1 MiB default frame limit of websockets clients
+HISTORY_FRAME_SIZE = 512 << 10
+history = collections.deque(maxlen=HISTORY_SIZE)
+history_id = uuid.uuid4().hex
+last_seq = 0
+
+# Set by `main` when the server runs as one node of a cluster
+cluster = None
+# Set by `main` when inbound traffic is being captured
+recorder = None
+# Set by `main` when chat messages are filtered against a list of banned words
+moderator = None
+# Set by `main` when chat messages are persisted
+chat_log = None
+# Set by `main` when the memory of the sessions is limited
+memory_budget = None
+# Incoming frames queued per connection before reading pauses, so a session buffers at most this many frames
+MAX_QUEUE = 8
+# Rough size of a history entry apart from the message text
+HISTORY_ENTRY_OVERHEAD = 512
 
 
 async def broadcast_to_all(message: typing.Union[str, dict], excluded_connections=None) -> None:
     if not connections:
         return
 
+    # Encode once for all recipients
+    if type(message) is dict:
+        message = json.dumps(message)
     excluded_connections = excluded_connections or set()
     coroutines = [send(conn, message) for conn in connections if conn not in excluded_connections]
     if coroutines:
-        await asyncio.wait(coroutines)
+        await asyncio.gather(*coroutines, return_exceptions=True)
+
+
+async def deliver(message: dict, excluded_connections=None) -> None:
+    """Record chat messages in the history and broadcast to local users."""
+    global last_seq
+
+    if message['type'] == 'chat':
+        last_seq += 1
+        message['seq'] = last_seq
+        history.append(message)
+        if chat_log is not None:
+            chat_log.append(message)
+    await broadcast_to_all(message, excluded_connections)
+
+
+async def publish(message: dict, excluded_connections=None) -> None:
+    """Deliver to local users and forward to the other nodes of the cluster, if any."""
+    await deliver(message, excluded_connections)
+    if cluster is not None:
+        cluster.forward(message)
+
+
+async def history_since(client_history_id, client_last_seq) -> list:
+    """Return the history frames for a client, holding only the messages it has not cached yet where possible."""
+    complete = False
+    missing = last_seq - client_last_seq if client_history_id == history_id and client_last_seq is not None else None
+    # A client ahead of the server has seen messages that were lost, so its cache does not match this history
+    if missing is not None and missing < 0:
+        missing = None
+    if missing is not None and missing <= len(history):
+        messages = list(history)[len(history) - max(0, missing):]
+    elif missing is not None and missing <= MAX_CATCH_UP and chat_log is not None:
+        chat_log.flush()
+        messages = await asyncio.get_event_loop().run_in_executor(
+            None, chat_log.read_since, client_last_seq, None, missing
+        )
+        # Messages published during the read are only in memory
+        read_seq = messages[-1]['seq'] if messages else client_last_seq
+        messages += [message for message in history if message['seq'] > read_seq]
+    else:
+        complete = True
+        messages = list(history)
+
+    # Split by encoded size into several frames to stay below the frame size limit of the clients
+    chunks = [[]]
+    chunk_size = 0
+    for message in messages:
+        size = len(json.dumps(message)) + 2
+        if chunks[-1] and chunk_size + size > HISTORY_FRAME_SIZE:
+            chunks.append([])
+            chunk_size = 0
+        chunks[-1].append(message)
+        chunk_size += size
+    return [
+        {
+            'type': 'history',
+            'complete': complete and i == 0,
+            'messages': chunk
+        }
+        for i, chunk in enumerate(chunks)
+    ]
+
+
+def history_bytes() -> int:
+    return sum(len(message['message']) + HISTORY_ENTRY_OVERHEAD for message in history)
 
 
 async def send(connection, message: typing.Union[str, dict], check_send_event=True) -> None:
@@ -71,26 +186,67 @@ async def send(connection, message: typing.Union[str, dict], check_send_event=Tr
     await asyncio.sleep(0)
 
 
-async def receive_username(connection):
-    data = json.loads(await connection.recv())
-    assert data['type'] == 'init'
-    return data['username']
+async def typing_broadcaster() -> None:
+    typing_usernames = []
+    while True:
+        await asyncio.sleep(TYPING_INTERVAL)
+
+        # Expire users who stopped typing
+        now = asyncio.get_event_loop().time()
+        for username in [username for username, deadline in typing_deadlines.items() if deadline <= now]:
+            del typing_deadlines[username]
+
+        # Broadcast one compact frame per interval, and only when the set of typing users changed
+        if sorted(typing_deadlines) != typing_usernames:
+            typing_usernames = sorted(typing_deadlines)
+            await broadcast_to_all({
+                'type': 'typing',
+                'usernames': typing_usernames
+            })
+
+
+async def receive_init_message(connection):
+    while True:
+        try:
+            message = messages.decode(await connection.recv())
+            if type(message) is messages.PingMessage:
+                # Latency probes may arrive before or instead of logging in
+                await send(connection, {'type': 'pong', 'id': message.id}, False)
+                continue
+            if type(message) is not messages.InitMessage:
+                raise messages.MessageError('unexpected_type')
+            return message
+        except messages.MessageError as e:
+            await send(connection, e.to_dict(), False)
 
 
 async def client_handler(connection):
+    accepted_connections.add(connection)
+    try:
+        await session_handler(connection)
+    finally:
+        accepted_connections.discard(connection)
+
+
+async def session_handler(connection):
     remote_address = connection.remote_address[0] + ':' + str(connection.remote_address[1])
     logger.info('Incoming connection from [' + remote_address + '].')
     try:
         # Get username
-        username = await receive_username(connection)
+        init_message = await receive_init_message(connection)
+        username = init_message.username
         while True:
-            if not username:
+            if memory_budget is not None and not memory_budget.admit():
+                await send(connection, {'type': 'server_busy'}, False)
+            elif not username:
                 await send(connection, {'type': 'empty_username'}, False)
-            elif username in username_to_connection:
+            elif username in username_to_connection or \
+                    (cluster is not None and not await cluster.claim(username)):
                 await send(connection, {'type': 'duplicate_username'}, False)
             else:
                 break
-            username = await receive_username(connection)
+            init_message = await receive_init_message(connection)
+            username = init_message.username
     except WebSocketException as e:
         logger.warning('The connection with [' + remote_address + '] is closed due to error: ' + str(e))
         return
@@ -98,22 +254,36 @@ async def client_handler(connection):
     # Record information of the user
     username_and_address = '[' + remote_address + '](' + username + ')'
     logger.info(username_and_address + ' logged in.')
-    send_event = asyncio.Event()
-    connections[connection] = (username, send_event)
     username_to_connection[username] = connection
     online_timestamp = int(time.time())
+    # Numbered only once logged in, so that latency probes and failed logins do not use up user ids
+    capture_user_id = recorder.new_user_id() if recorder is not None else None
+    if recorder is not None:
+        recorder.record(capture.INIT, capture_user_id)
 
     try:
+        # Take the history snapshot before registering the connection for broadcasts. Messages published from then on
+        # are queued for live delivery behind `send_event`, so no message is both in the history and delivered live.
+        history_frames = await history_since(init_message.history_id, init_message.last_seq)
+        del init_message
+        send_event = asyncio.Event()
+        connections[connection] = (username, send_event)
+
         # Notify the user of successful login and total number of currently online users
         await send(connection, {
             'type': 'online_success',
-            'number_of_online_users': len(connections),
-            'timestamp': online_timestamp
+            'number_of_online_users':
+                len(connections) + (cluster.number_of_remote_sessions() if cluster is not None else 0),
+            'timestamp': online_timestamp,
+            'history_id': history_id
         }, False)
+        for frame in history_frames:
+            await send(connection, frame, False)
+        del history_frames
         send_event.set()
 
         # Notify other users that this user is online
-        await broadcast_to_all({
+        await publish({
             'type': 'user_online',
             'username': username,
             'timestamp': online_timestamp
@@ -122,12 +292,36 @@ async def client_handler(connection):
 
         # Read messages from this user and broadcast them to all the users
         async for message in connection:
-            data = json.loads(message)
-            assert data['type'] == 'chat'
-            data['message'] = data['message'].strip()
-            if data['message']:
-                data['timestamp'] = int(time.time())
-                await broadcast_to_all(data)
+            try:
+                data = messages.decode(message)
+            except messages.MessageError as e:
+                await send(connection, e.to_dict())
+                continue
+
+            if type(data) is messages.PingMessage:
+                await send(connection, {'type': 'pong', 'id': data.id})
+            elif type(data) is messages.TypingMessage:
+                typing_deadlines[username] = asyncio.get_event_loop().time() + TYPING_TIMEOUT
+            elif type(data) is messages.ChatMessage:
+                typing_deadlines.pop(username, None)
+                text = data.message.strip()
+                if text and moderator is not None:
+                    text = moderator.moderate(username, text)
+                    if text is None:
+                        await send(connection, messages.MessageError('message_blocked').to_dict())
+                if text:
+                    # Only broadcast messages are captured, so that a replay sends the same traffic
+                    if recorder is not None:
+                        recorder.record(capture.CHAT, capture_user_id, len(text))
+                    await publish({
+                        'type': 'chat',
+                        'username': username,
+                        'message': text,
+                        'timestamp': int(time.time())
+                    })
+                del text
+            else:
+                await send(connection, messages.MessageError('unexpected_type').to_dict())
             del data
 
         logger.info(username_and_address + ' disconnected.')
@@ -137,23 +331,109 @@ async def client_handler(connection):
 
     finally:
         # User disconnected
-        del connections[connection]
+        connections.pop(connection, None)
         del username_to_connection[username]
+        typing_deadlines.pop(username, None)
+        if cluster is not None:
+            cluster.release(username)
+        if recorder is not None:
+            recorder.record(capture.DISCONNECT, capture_user_id)
 
         # Notify other users that this user is offline
-        await broadcast_to_all({
+        await publish({
             'type': 'user_offline',
             'username': username,
             'timestamp': int(time.time())
         })
 
 
+async def serve_cluster(host, cluster_port):
+    # Links are authenticated during the handshake, and frames are bounded like client frames
+    async with websockets.serve(cluster.peer_handler, host, cluster_port, ping_interval=None,
+                                max_size=cluster_module.MAX_LINK_FRAME_SIZE, process_request=cluster.process_request):
+        logger.info('Cluster node [' + cluster.node + '] listening at [' + host + ':' + str(cluster_port) + '].')
+        cluster.start()
+        try:
+            await asyncio.Future()
+        finally:
+            cluster.stop()
+
+
 @print_execution_time('Server closed.')
-async def main(host, port):
-    async with websockets.serve(client_handler, host, port) as server:
-        logger.info('Server successfully started at [' + host + ':' + str(port) + '].')
-        await server.serve_forever()
+async def main(host, port, cluster_port=None, node_address=None, peers=(), capture_path=None,
+               banned_words_path=None, moderation_action=moderation.MASK, watchdog_threshold=0.1, log_directory=None,
+               memory_limit=None, cluster_host=None, cluster_secret=None):
+    global cluster, recorder, moderator, chat_log, memory_budget, history_id, last_seq
+
+    tasks = [asyncio.ensure_future(typing_broadcaster())]
+    if watchdog_threshold:
+        tasks.append(asyncio.ensure_future(LoopWatchdog(watchdog_threshold).heartbeat()))
+    if cluster_port is not None:
+        if not cluster_secret:
+            raise ValueError('a cluster needs a shared secret')
+        node_address = node_address or '127.0.0.1:' + str(cluster_port)
+        cluster = cluster_module.Cluster(node_address, peers, deliver, cluster_secret)
+        # Only the nodes need to reach the cluster port, so it listens on the node address rather than on `host`
+        tasks.append(asyncio.ensure_future(serve_cluster(cluster_host or node_address.rsplit(':', 1)[0], cluster_port)))
+    if capture_path is not None:
+        recorder = capture.Recorder(capture_path)
+        logger.info('Capturing inbound traffic to [' + capture_path + '].')
+    if log_directory is not None:
+        chat_log = ChatLog(log_directory)
+        history_id = chat_log.history_id
+        last_seq = chat_log.last_seq
+        history.extend(chat_log.read_since(last_seq - HISTORY_SIZE))
+        tasks.append(asyncio.ensure_future(chat_log.maintain_forever()))
+        logger.info('Persisting chat messages to [' + log_directory + '], last sequence number ' + str(last_seq) + '.')
+    if banned_words_path is not None:
+        moderator = moderation.Moderator(banned_words_path, moderation_action)
+        tasks.append(asyncio.ensure_future(moderator.watch()))
+    if memory_limit is not None:
+        memory_budget = MemoryBudget(memory_limit, accepted_connections, history_bytes)
+        tasks.append(asyncio.ensure_future(memory_budget.enforce_forever()))
+        logger.info('Memory budget of ' + str(memory_limit >> 20) + ' MiB for sessions and history.')
+    try:
+        async with websockets.serve(client_handler, host, port, max_size=messages.MAX_FRAME_SIZE, max_queue=MAX_QUEUE,
+                                    process_request=memory_budget.process_request if memory_budget else None) as server:
+            logger.info('Server successfully started at [' + host + ':' + str(port) + '].')
+            await server.serve_forever()
+    finally:
+        for task in tasks:
+            task.cancel()
+        if recorder is not None:
+            recorder.close()
+        if chat_log is not None:
+            chat_log.close()
 
 
 if __name__ == '__main__':
-    asyncio.run(main('0.0.0.0', 34999))
+    parser = argparse.ArgumentParser(description='Simple Chat server.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=34999)
+    parser.add_argument('--cluster-port', type=int, default=None,
+                        help='port for links from other nodes; the server runs standalone if omitted')
+    parser.add_argument('--node-address', default=None,
+                        help='host:port under which other nodes reach this node (default 127.0.0.1:CLUSTER_PORT)')
+    parser.add_argument('--cluster-host', default=None,
+                        help='interface for the cluster port (default the host of the node address)')
+    parser.add_argument('--peers', nargs='*', default=[], help='host:port of every node of the cluster')
+    parser.add_argument('--capture', default=None, help='record anonymized inbound traffic to this file')
+    parser.add_argument('--banned-words', default=None, help='file with one banned word per line, reloaded on change')
+    parser.add_argument('--moderation-action', choices=moderation.ACTIONS, default=moderation.MASK)
+    parser.add_argument('--watchdog-threshold', type=float, default=0.1,
+                        help='log event loop stalls longer than this many seconds, 0 to disable')
+    parser.add_argument('--log-dir', default=None, help='persist chat messages in this directory')
+    parser.add_argument('--memory-budget', type=int, default=None,
+                        help='approximate memory in MiB for sessions and history; unlimited if omitted')
+    args = parser.parse_args()
+    cluster_secret = os.environ.get(cluster_module.SECRET_ENVIRONMENT_VARIABLE)
+    if args.cluster_port is not None and not cluster_secret:
+        parser.error('--cluster-port requires a shared secret in the ' + cluster_module.SECRET_ENVIRONMENT_VARIABLE +
+                     ' environment variable')
+
+    # Shut down on SIGTERM as on Ctrl-C, so that the chat log and the capture are closed cleanly
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    asyncio.run(main(args.host, args.port, args.cluster_port, args.node_address, args.peers, args.capture,
+                     args.banned_words, args.moderation_action, args.watchdog_threshold, args.log_dir,
+                     args.memory_budget << 20 if args.memory_budget is not None else None, args.cluster_host,
+                     cluster_secret))
@@ -0,0 +1,79 @@
+import asyncio
+import json
+import os
+import time
+
+import websockets
+from websockets.exceptions import WebSocketException
+
+DEFAULT_ENDPOINTS = ['ws://127.0.0.1:34999/']
+RANKING_PATH = os.path.join(os.path.expanduser('~'), '.simple_chat', 'servers.json')
+PROBE_TIMEOUT = 2.0
+
+
+async def ping(connection, ping_id=0) -> float:
+    """Measure the round trip time of an application level ping on an idle connection."""
+    t0 = time.perf_counter()
+    await connection.send(json.dumps({'type': 'ping', 'id': ping_id}))
+    while True:
+        data = json.loads(await connection.recv())
+        if data['type'] == 'pong' and data['id'] == ping_id:
+            return time.perf_counter() - t0
+
+
+async def probe(url) -> float:
+    """Return the round trip time to the server at `url`, or None if it is not healthy."""
+    try:
+        async with websockets.connect(url, ping_interval=None, open_timeout=PROBE_TIMEOUT) as connection:
+            return await asyncio.wait_for(ping(connection), PROBE_TIMEOUT)
+    except (OSError, asyncio.TimeoutError, WebSocketException):
+        return None
+
+
+def load_ranking(urls) -> list:
+    """Return `urls` ordered by the last measured ranking, without probing."""
+    try:
+        with open(RANKING_PATH) as f:
+            ranking = json.load(f)
+    except (OSError, ValueError):
+        ranking = []
+    return [url for url in ranking if url in urls] + [url for url in urls if url not in ranking]
+
+
+def save_ranking(ranking) -> None:
+    try:
+        os.makedirs(os.path.dirname(RANKING_PATH), exist_ok=True)
+        with open(RANKING_PATH, 'w') as f:
+            json.dump(ranking, f)
+    except OSError:
+        pass
+
+
+async def rank(urls) -> list:
+    """Probe all endpoints in parallel and return the healthy ones as (url, round trip time), fastest first."""
+    rtts = await asyncio.gather(*(probe(url) for url in urls))
+    ranking = sorted(((url, rtt) for url, rtt in zip(urls, rtts) if rtt is not None), key=lambda item: item[1])
+    save_ranking([url for url, _ in ranking] + [url for url, rtt in zip(urls, rtts) if rtt is None])
+    return ranking
+
+
+async def connect(urls, probe_first=True):
+    """
+    Connect to the lowest latency healthy endpoint and return (connection, url).
+
+    With `probe_first` disabled, for example when failing over after a disconnect, the cached ranking is tried in order
+    without probing.
+    """
+    if probe_first:
+        order = [url for url, _ in await rank(urls)]
+        order += [url for url in load_ranking(urls) if url not in order]
+    else:
+        order = load_ranking(urls)
+
+    error = None
+    for url in order:
+        try:
+            return await websockets.connect(url, ping_interval=None, open_timeout=PROBE_TIMEOUT), url
+        except (OSError, asyncio.TimeoutError, WebSocketException) as e:
+            error = e
+    raise ConnectionError('no server available: ' + str(error))
@@ -0,0 +1,197 @@
+import argparse
+import asyncio
+import collections
+import json
+import random
+import time
+import typing
+
+from loguru import logger
+from websockets.exceptions import ConnectionClosedOK
+
+import server
+
+
+class _VirtualSelector:
+    """Wrap a real selector so that waiting for timers advances the virtual clock instead of sleeping."""
+
+    def __init__(self, selector, loop):
+        self._selector = selector
+        self._loop = loop
+
+    def select(self, timeout=None):
+        if timeout is not None and timeout > 0:
+            self._loop.advance(timeout)
+            timeout = 0
+        return self._selector.select(timeout)
+
+    def __getattr__(self, name):
+        return getattr(self._selector, name)
+
+
+class VirtualClockEventLoop(asyncio.SelectorEventLoop):
+    """An event loop whose clock only moves forward when there is nothing ready to run."""
+
+    def __init__(self):
+        super().__init__()
+        self._virtual_time = 0.0
+        self._selector = _VirtualSelector(self._selector, self)
+
+    def time(self):
+        return self._virtual_time
+
+    def advance(self, seconds):
+        self._virtual_time += seconds
+
+
+_CLOSE = object()
+
+
+class MemoryConnection:
+    """
+    In-process stand-in for a websocket connection.
+
+    Implements the parts of the websocket interface used by the server (`recv`, `send`, async iteration and
+    `remote_address`). The simulated client pushes frames with `feed` and disconnects with `close`.
+    """
+
+    def __init__(self, remote_address, send_delay=0.0, max_kept_frames=16):
+        self.remote_address = remote_address
+        self.send_delay = send_delay
+
+        self.inbox = asyncio.Queue()
+        self.frames = collections.deque(maxlen=max_kept_frames)
+        self.number_of_frames = 0
+        self.number_of_recvs = 0
+        self.closed = False
+
+    def feed(self, message: typing.Union[str, dict]) -> None:
+        if type(message) is dict:
+            message = json.dumps(message)
+        self.inbox.put_nowait(message)
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.inbox.put_nowait(_CLOSE)
+
+    async def recv(self) -> str:
+        self.number_of_recvs += 1
+        message = await self.inbox.get()
+        if message is _CLOSE:
+            self.inbox.put_nowait(_CLOSE)
+            raise ConnectionClosedOK(None, None)
+        return message
+
+    async def send(self, message: str) -> None:
+        if self.closed:
+            raise ConnectionClosedOK(None, None)
+        if self.send_delay:
+            await asyncio.sleep(self.send_delay)
+        self.frames.append(message)
+        self.number_of_frames += 1
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        while True:
+            try:
+                yield await self.recv()
+            except ConnectionClosedOK:
+                return
+
+
+def run(coroutine):
+    """Run a coroutine to completion on a fresh virtual clock event loop."""
+    loop = VirtualClockEventLoop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def reset_server() -> None:
+    """Start from a clean server, also when simulating several times in one process."""
+    server.connections.clear()
+    server.accepted_connections.clear()
+    server.username_to_connection.clear()
+    server.typing_deadlines.clear()
+    server.history.clear()
+    server.last_seq = 0
+
+
+async def simulate(number_of_users, number_of_messages, slow_consumer_ratio=0.0, slow_consumer_delay=0.5,
+                   disconnect_ratio=1.0, seed=0) -> dict:
+    rng = random.Random(seed)
+    loop = asyncio.get_event_loop()
+    stats = dict()
+    reset_server()
+
+    # Log in all users
+    t0, v0 = time.perf_counter(), loop.time()
+    connections = []
+    handlers = []
+    for i in range(number_of_users):
+        connection = MemoryConnection(
+            ('10.' + str(i >> 16 & 255) + '.' + str(i >> 8 & 255) + '.' + str(i & 255), 40000 + i % 20000),
+            slow_consumer_delay if rng.random() < slow_consumer_ratio else 0.0
+        )
+        connection.feed({'type': 'init', 'username': 'user' + str(i)})
+        connections.append(connection)
+        handlers.append(asyncio.ensure_future(server.client_handler(connection)))
+    while len(server.connections) < number_of_users:
+        await asyncio.sleep(0.001)
+    stats['login_seconds'] = time.perf_counter() - t0
+    stats['login_virtual_seconds'] = loop.time() - v0
+
+    # A handler reads its next frame only after the `user_online` fan-out of its login has been delivered
+    while any(connection.number_of_recvs < 2 for connection in connections):
+        await asyncio.sleep(0.001)
+    stats['login_fan_out_seconds'] = time.perf_counter() - t0
+
+    # Broadcast chat messages from random users and wait until every frame is delivered
+    t0, v0 = time.perf_counter(), loop.time()
+    frames_before = sum(connection.number_of_frames for connection in connections)
+    for i in range(number_of_messages):
+        connection = connections[rng.randrange(number_of_users)]
+        connection.feed({'type': 'chat', 'username': server.connections[connection][0], 'message': 'm' + str(i)})
+    await asyncio.sleep(slow_consumer_delay * number_of_messages + 1)
+    stats['chat_seconds'] = time.perf_counter() - t0
+    stats['chat_frames'] = sum(connection.number_of_frames for connection in connections) - frames_before
+
+    # Disconnect a share of the users at once
+    t0, v0 = time.perf_counter(), loop.time()
+    storm = rng.sample(range(number_of_users), int(number_of_users * disconnect_ratio))
+    for i in storm:
+        connections[i].close()
+    await asyncio.gather(*(handlers[i] for i in storm))
+    stats['disconnect_seconds'] = time.perf_counter() - t0
+    stats['disconnect_virtual_seconds'] = loop.time() - v0
+    stats['remaining_connections'] = len(server.connections)
+
+    for connection in connections:
+        connection.close()
+    await asyncio.gather(*handlers)
+
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate users against the chat server in a single process.')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--slow-consumer-ratio', type=float, default=0.01)
+    parser.add_argument('--slow-consumer-delay', type=float, default=0.5)
+    parser.add_argument('--disconnect-ratio', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logger.disable('server')
+    result = run(simulate(args.users, args.messages, args.slow_consumer_ratio, args.slow_consumer_delay,
+                          args.disconnect_ratio, args.seed))
+    for key, value in result.items():
+        print(key + ': ' + str(round(value, 4) if type(value) is float else value))
@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+import chat_log
+
+
+def message(seq):
+    return {'type': 'chat', 'seq': seq, 'timestamp': 1000 + seq, 'username': 'amy', 'message': 'm' * 50}
+
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    monkeypatch.setattr(chat_log, 'SEGMENT_SIZE', 2000)
+    monkeypatch.setattr(chat_log, 'BLOCK_SIZE', 500)
+
+
+def test_archive_round_trip(tmp_path, small_segments):
+    log = chat_log.ChatLog(str(tmp_path))
+    for seq in range(1, 201):
+        log.append(message(seq))
+    log.compact(log.closed_segments(), bytes_per_second=1e12)
+    for seq in range(201, 221):
+        log.append(message(seq))
+    log.flush()
+
+    assert os.listdir(str(tmp_path)).count('segment-%012d.jsonl' % 1) == 0
+    assert [m['seq'] for m in log.read_since()] == list(range(1, 221))
+    assert [m['seq'] for m in log.read_since(150, limit=10)] == list(range(151, 161))
+    assert [m['seq'] for m in log.read_since(timestamp=1210)] == list(range(210, 221))
+    log.close()
+
+    # A reopened log continues the sequence space
+    reopened = chat_log.ChatLog(str(tmp_path))
+    assert reopened.history_id == log.history_id
+    assert reopened.last_seq == 220
+    reopened.close()
+
+
+def test_unclean_shutdown_starts_a_new_history(tmp_path):
+    log = chat_log.ChatLog(str(tmp_path))
+    log.append(message(1))
+    log.flush()
+
+    # Messages after the last flush may be lost in a crash, so their sequence numbers must not be trusted
+    crashed = chat_log.ChatLog(str(tmp_path))
+    assert crashed.history_id != log.history_id
+    assert crashed.last_seq == 1
+    crashed.close()
+    log.close()
+
+
+def test_corrupted_block_is_detected(tmp_path, small_segments):
+    log = chat_log.ChatLog(str(tmp_path))
+    for seq in range(1, 101):
+        log.append(message(seq))
+    log.compact(log.closed_segments(), bytes_per_second=1e12)
+    log.close()
+
+    archive = os.path.join(str(tmp_path), 'archive-%012d.sca' % 1)
+    with open(archive, 'r+b') as f:
+        f.seek(len(chat_log.ARCHIVE_MAGIC) + 5)
+        f.write(b'\x00\x00\x00')
+    with pytest.raises(ValueError):
+        chat_log.ChatLog(str(tmp_path)).read_since()
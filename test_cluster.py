@@ -0,0 +1,26 @@
+import cluster
+
+NODES = ['10.0.0.' + str(i) + ':35999' for i in range(4)]
+KEYS = ['user' + str(i) for i in range(2000)]
+
+
+def test_owner_is_deterministic_and_balanced():
+    ring = cluster.HashRing(NODES)
+    owners = [ring.owner(key) for key in KEYS]
+    assert owners == [cluster.HashRing(reversed(NODES)).owner(key) for key in KEYS]
+    for node in NODES:
+        assert len(KEYS) / len(NODES) / 2 < owners.count(node) < len(KEYS) / len(NODES) * 2
+
+
+def test_removing_a_node_only_moves_its_keys():
+    ring = cluster.HashRing(NODES)
+    before = {key: ring.owner(key) for key in KEYS}
+    ring.remove(NODES[0])
+    for key in KEYS:
+        if before[key] != NODES[0]:
+            assert ring.owner(key) == before[key]
+        else:
+            assert ring.owner(key) != NODES[0]
+
+    ring.add(NODES[0])
+    assert {key: ring.owner(key) for key in KEYS} == before
@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+import messages
+
+
+def test_decode_typed_messages():
+    init = messages.decode(json.dumps({'type': 'init', 'username': 'amy', 'history_id': 'h', 'last_seq': 3}))
+    assert type(init) is messages.InitMessage
+    assert (init.username, init.history_id, init.last_seq) == ('amy', 'h', 3)
+    assert messages.decode('{"type": "chat", "message": "hi"}').message == 'hi'
+    assert messages.decode(b'{"type": "ping", "id": 7}').id == 7
+    assert type(messages.decode('{"type": "typing"}')) is messages.TypingMessage
+
+
+@pytest.mark.parametrize('frame, reason', [
+    ('not json', 'malformed_frame'),
+    ('[1, 2]', 'malformed_frame'),
+    (b'\xff', 'malformed_frame'),
+    ('{"type": "shout"}', 'unknown_type'),
+    ('{"message": "hi"}', 'unknown_type'),
+    ('{"type": "init", "username": 1}', 'invalid_username'),
+    ('{"type": "init", "username": "' + 'a' * (messages.MAX_USERNAME_LENGTH + 1) + '"}', 'username_too_long'),
+    ('{"type": "init", "username": "amy", "last_seq": "3"}', 'invalid_history_position'),
+    ('{"type": "chat"}', 'invalid_message_body'),
+    ('{"type": "ping", "id": "7"}', 'invalid_ping_id'),
+])
+def test_decode_rejects_invalid_frames(frame, reason):
+    with pytest.raises(messages.MessageError) as e:
+        messages.decode(frame)
+    assert e.value.to_dict() == {'type': 'invalid_message', 'reason': reason}
+
+
+def test_longest_valid_message_fits_in_a_frame():
+    for char in ('a', '中', '😀'):
+        frame = json.dumps({'type': 'chat', 'message': char * messages.MAX_MESSAGE_LENGTH})
+        assert messages.decode(frame).message == char * messages.MAX_MESSAGE_LENGTH
+
+    frame = json.dumps({'type': 'chat', 'message': '中' * (messages.MAX_MESSAGE_LENGTH + 1)})
+    with pytest.raises(messages.MessageError) as e:
+        messages.decode(frame)
+    assert e.value.reason == 'message_too_long'
@@ -0,0 +1,27 @@
+import moderation
+
+
+def test_finds_overlapping_and_nested_words():
+    automaton = moderation.Automaton(['he', 'she', 'his', 'hers'])
+    assert automaton.find('ushers') == [(1, 4), (2, 6)]
+    assert automaton.find('nothing here') == [(8, 10)]
+    assert automaton.find('xyz') == []
+
+
+def test_matching_ignores_case_and_needs_no_segmentation():
+    automaton = moderation.Automaton(['Bad', '坏词'])
+    text = 'A BAD message with 一个坏词在中间'
+    spans = automaton.find(text)
+    assert spans == [(2, 5), (21, 23)]
+    assert moderation.mask(text, spans) == 'A *** message with 一个**在中间'
+
+
+def test_moderator_actions(tmp_path):
+    path = tmp_path / 'banned.txt'
+    path.write_text('# comment\nbad\n\n', encoding='utf-8')
+    assert moderation.load_words(str(path)) == ['bad']
+
+    assert moderation.Moderator(str(path), moderation.MASK).moderate('amy', 'so bad') == 'so ***'
+    assert moderation.Moderator(str(path), moderation.DROP).moderate('amy', 'so bad') is None
+    assert moderation.Moderator(str(path), moderation.FLAG).moderate('amy', 'so bad') == 'so bad'
+    assert moderation.Moderator(str(path), moderation.DROP).moderate('amy', 'fine') == 'fine'
@@ -0,0 +1,54 @@
+import asyncio
+import json
+
+from loguru import logger
+
+import server
+import simulation
+
+logger.disable('server')
+
+
+def test_every_chat_message_reaches_every_user():
+    stats = simulation.run(simulation.simulate(50, 5))
+    assert stats['chat_frames'] == 250
+    assert stats['remaining_connections'] == 0
+
+
+def test_runs_are_reproducible_in_one_process():
+    first = simulation.run(simulation.simulate(30, 4, slow_consumer_ratio=0.2, disconnect_ratio=0.5))
+    second = simulation.run(simulation.simulate(30, 4, slow_consumer_ratio=0.2, disconnect_ratio=0.5))
+    assert first['chat_frames'] == second['chat_frames'] == 120
+    assert first['remaining_connections'] == second['remaining_connections'] == 15
+    # The second run numbers its messages from the start again
+    assert server.last_seq == len(server.history) == 4
+
+
+def test_chat_during_login_is_delivered_once():
+    async def scenario():
+        simulation.reset_server()
+        alice = simulation.MemoryConnection(('10.0.0.1', 40000))
+        alice.feed({'type': 'init', 'username': 'alice'})
+        handlers = [asyncio.ensure_future(server.client_handler(alice))]
+        await asyncio.sleep(0.01)
+
+        # Bob is a slow consumer, so alice's message is published while he is still being logged in
+        bob = simulation.MemoryConnection(('10.0.0.2', 40000), send_delay=0.5)
+        bob.feed({'type': 'init', 'username': 'bob'})
+        handlers.append(asyncio.ensure_future(server.client_handler(bob)))
+        await asyncio.sleep(0.1)
+        alice.feed({'type': 'chat', 'message': 'hello'})
+        await asyncio.sleep(5)
+
+        received = []
+        for frame in map(json.loads, bob.frames):
+            if frame['type'] == 'history':
+                received += frame['messages']
+            elif frame['type'] == 'chat':
+                received.append(frame)
+        alice.close()
+        bob.close()
+        await asyncio.gather(*handlers)
+        return received
+
+    assert [message['message'] for message in simulation.run(scenario())] == ['hello']